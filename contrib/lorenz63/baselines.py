@@ -0,0 +1,199 @@
+"""
+Classical data assimilation baselines for Lorenz-63 windows.
+
+Both methods process whole batches of windows at once, on the observations of `training_da`
+in physical units: (batch, component, time) tensors with NaN where not observed, one window
+per row, starting from a (batch, component) background state.
+
+- `fourdvar`: strong-constraint incremental 4DVar. The control is the initial state of each
+  window; the Gauss-Newton inner problems are solved by conjugate gradient with the tangent
+  linear of the RK4 integration of the model (`tl_rk4_step`, evaluated once per outer
+  iteration as the (3, 3) matrices of all the steps of all the windows) and its adjoint.
+- `enkf`: stochastic ensemble Kalman filter with perturbed observations, the observed
+  components being assimilated one after the other.
+"""
+
+import torch
+import contrib.lorenz63.models as l63_models
+
+
+def tl_lorenz63(x, dx, sigma=10., rho=28., beta=8./3):
+    """ Tangent linear of `models.dyn_lorenz63_torch` at `x` applied to `dx`, (batch, component, ...) tensors. """
+    x_1, x_2, x_3 = x.unbind(1)
+    dx_1, dx_2, dx_3 = dx.unbind(1)
+    return torch.stack([
+        sigma * (dx_2 - dx_1),
+        (rho - x_3) * dx_1 - dx_2 - x_1 * dx_3,
+        x_2 * dx_1 + x_1 * dx_2 - beta * dx_3,
+    ], dim=1)
+
+
+def adj_lorenz63(x, lx, sigma=10., rho=28., beta=8./3):
+    """ Adjoint of `tl_lorenz63` at `x` applied to `lx`. """
+    x_1, x_2, x_3 = x.unbind(1)
+    lx_1, lx_2, lx_3 = lx.unbind(1)
+    return torch.stack([
+        -sigma * lx_1 + (rho - x_3) * lx_2 + x_2 * lx_3,
+        sigma * lx_1 - lx_2 + x_1 * lx_3,
+        -x_1 * lx_2 - beta * lx_3,
+    ], dim=1)
+
+
+def rk4_stage_points(x, dt, **dyn_kw):
+    """ RK4 step of `x` over `dt`, also returning the 4 points where the step evaluates the model. """
+    k1 = l63_models.dyn_lorenz63_torch(x, **dyn_kw)
+    p2 = x + dt/2 * k1
+    k2 = l63_models.dyn_lorenz63_torch(p2, **dyn_kw)
+    p3 = x + dt/2 * k2
+    k3 = l63_models.dyn_lorenz63_torch(p3, **dyn_kw)
+    p4 = x + dt * k3
+    k4 = l63_models.dyn_lorenz63_torch(p4, **dyn_kw)
+    return x + dt/6 * (k1 + 2*k2 + 2*k3 + k4), (x, p2, p3, p4)
+
+
+def tl_rk4_step(points, dx, dt, **dyn_kw):
+    """ Tangent linear of the RK4 step with stage `points` (see `rk4_stage_points`) applied to `dx`. """
+    x, p2, p3, p4 = points
+    dk1 = tl_lorenz63(x, dx, **dyn_kw)
+    dk2 = tl_lorenz63(p2, dx + dt/2 * dk1, **dyn_kw)
+    dk3 = tl_lorenz63(p3, dx + dt/2 * dk2, **dyn_kw)
+    dk4 = tl_lorenz63(p4, dx + dt * dk3, **dyn_kw)
+    return dx + dt/6 * (dk1 + 2*dk2 + 2*dk3 + dk4)
+
+
+def adj_rk4_step(points, lx, dt, **dyn_kw):
+    """ Adjoint of `tl_rk4_step` applied to `lx`. """
+    x, p2, p3, p4 = points
+    a4 = adj_lorenz63(p4, dt/6 * lx, **dyn_kw)
+    a3 = adj_lorenz63(p3, dt/3 * lx + dt * a4, **dyn_kw)
+    a2 = adj_lorenz63(p2, dt/3 * lx + dt/2 * a3, **dyn_kw)
+    a1 = adj_lorenz63(x, dt/6 * lx + dt/2 * a2, **dyn_kw)
+    return lx + a1 + a2 + a3 + a4
+
+
+def forecast(x0, n_time, dt, **dyn_kw):
+    """
+    (batch, component, time) RK4 trajectories from `x0`, and the stage points of all the
+    steps as (batch, component, time - 1) tensors.
+    """
+    states, points = [x0], []
+    for _ in range(n_time - 1):
+        state, step_points = rk4_stage_points(states[-1], dt, **dyn_kw)
+        states.append(state)
+        points.append(step_points)
+    return torch.stack(states, dim=-1), tuple(torch.stack(p, dim=-1) for p in zip(*points))
+
+
+def step_jacobians(points, dt, **dyn_kw):
+    """ (batch, time - 1, component, component) tangent linear matrices of all the RK4 steps at once. """
+    points = tuple(p[..., None] for p in points)
+    eye = torch.eye(points[0].shape[1], dtype=points[0].dtype, device=points[0].device)
+    directions = eye[:, None].expand(points[0].shape[0], -1, points[0].shape[2], -1)
+    return tl_rk4_step(points, directions, dt, **dyn_kw).movedim(2, 1)
+
+
+def _tl_sweep(jacs, dx0):
+    dxs = [dx0]
+    for t in range(jacs.shape[1]):
+        dxs.append((jacs[:, t] @ dxs[-1][..., None])[..., 0])
+    return torch.stack(dxs, dim=-1)
+
+
+def _adj_sweep(jacs, forcing):
+    lx = forcing[..., -1]
+    for t in reversed(range(jacs.shape[1])):
+        lx = (jacs[:, t].mT @ lx[..., None])[..., 0] + forcing[..., t]
+    return lx
+
+
+def _safe_div(num, den):
+    # converged rows have zero numerator and denominator
+    return num / torch.where(den > 0, den, torch.ones_like(den))
+
+
+def _batched_cg(matvec, rhs, n_iter):
+    """ Conjugate gradient solve of `matvec(x) = rhs`, independently for each row. """
+    x, res = torch.zeros_like(rhs), rhs.clone()
+    direction, res_norm = res.clone(), res.pow(2).sum(1, keepdim=True)
+    for _ in range(n_iter):
+        mat_dir = matvec(direction)
+        alpha = _safe_div(res_norm, (direction * mat_dir).sum(1, keepdim=True))
+        x, res = x + alpha * direction, res - alpha * mat_dir
+        new_res_norm = res.pow(2).sum(1, keepdim=True)
+        direction = res + _safe_div(new_res_norm, res_norm) * direction
+        res_norm = new_res_norm
+    return x
+
+
+def fourdvar(obs, background, dt=0.01, obs_sigma=2**.5, background_sigma=1., n_outer=5, n_inner=3, **dyn_kw):
+    """
+    Strong-constraint incremental 4DVar of batches of windows.
+
+    Minimizes over the initial state x0 of each window
+    `|x0 - background|^2 / (2 background_sigma^2) + sum_t |obs_t - x_t|^2 / (2 obs_sigma^2)`
+    (observed points only) with `n_outer` Gauss-Newton iterations, whose linearized problems
+    are solved by `n_inner` conjugate gradient iterations (exact after 3 for the 3 components).
+
+    Args:
+        obs (torch.Tensor): (batch, component, time) observations, NaN where not observed.
+        background (torch.Tensor): (batch, component) background initial states.
+        dt (float): Time step of the windows.
+        **dyn_kw: Parameters of `models.dyn_lorenz63_torch`.
+
+    Returns:
+        torch.Tensor: (batch, component, time) analysis trajectories.
+    """
+    msk = obs.isfinite().to(obs.dtype)
+    obs = obs.nan_to_num()
+    x0 = background.clone()
+    for _ in range(n_outer):
+        traj, points = forecast(x0, obs.shape[-1], dt, **dyn_kw)
+        jacs = step_jacobians(points, dt, **dyn_kw)
+        rhs = _adj_sweep(jacs, msk * (obs - traj) / obs_sigma**2) - (x0 - background) / background_sigma**2
+        hessian = lambda v, jacs=jacs: v / background_sigma**2 + _adj_sweep(
+            jacs, msk * _tl_sweep(jacs, v) / obs_sigma**2
+        )
+        x0 = x0 + _batched_cg(hessian, rhs, n_inner)
+    return forecast(x0, obs.shape[-1], dt, **dyn_kw)[0]
+
+
+def enkf(obs, background, n_members=32, dt=0.01, obs_sigma=2**.5, background_sigma=1., inflation=1., seed=None,
+         **dyn_kw):
+    """
+    Stochastic ensemble Kalman filter of batches of windows.
+
+    The `n_members` members of all windows are integrated together; at each time step with
+    observations the ensembles are inflated by `inflation` and every observed component is
+    assimilated with perturbed observations, windows without that observation being left
+    unchanged.
+
+    Args:
+        obs (torch.Tensor): (batch, component, time) observations, NaN where not observed.
+        background (torch.Tensor): (batch, component) mean of the initial ensembles, drawn with
+            `background_sigma` spread.
+        seed (int, optional): Seed of the initial ensembles and observation perturbations.
+        **dyn_kw: Parameters of `models.dyn_lorenz63_torch`.
+
+    Returns:
+        torch.Tensor: (batch, component, time) ensemble mean (filter) trajectories.
+    """
+    generator = None if seed is None else torch.Generator().manual_seed(seed)
+    randn = lambda *shape: torch.randn(*shape, generator=generator, dtype=obs.dtype).to(obs.device)
+    n_batch, n_comp, n_time = obs.shape
+    ens = background[:, None] + background_sigma * randn(n_batch, n_members, n_comp)
+    means = []
+    for t in range(n_time):
+        if t > 0:
+            ens = l63_models.rk4_lorenz63(ens.flatten(0, 1), dt, **dyn_kw).view(n_batch, n_members, n_comp)
+        observed = obs[..., t].isfinite()
+        if observed.any():
+            ens = ens.mean(1, keepdim=True) + inflation * (ens - ens.mean(1, keepdim=True))
+        for comp in observed.any(0).nonzero().flatten().tolist():
+            anomalies = ens - ens.mean(1, keepdim=True)
+            cov = (anomalies * anomalies[..., comp, None]).sum(1) / (n_members - 1)
+            gain = cov / (cov[:, comp, None] + obs_sigma**2)
+            perturbed = obs[:, comp, t, None].nan_to_num() + obs_sigma * randn(n_batch, n_members)
+            innovation = (perturbed - ens[..., comp]) * observed[:, comp, None]
+            ens = ens + innovation[..., None] * gain[:, None]
+        means.append(ens.mean(1))
+    return torch.stack(means, dim=-1)
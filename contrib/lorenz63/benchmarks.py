@@ -0,0 +1,724 @@
+"""Throughput benchmarks for the lorenz63 contribution."""
+
+import collections
+import concurrent.futures
+import functools as ft
+import itertools
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+import kornia.filters as kfilts
+import numpy as np
+import toolz
+import torch.profiler
+import torch.utils.flop_counter
+import torch.utils.data
+import xarray as xr
+import src.data
+import src.models
+import contrib.lorenz63.baselines as l63_baselines
+import contrib.lorenz63.data as l63_data
+import contrib.lorenz63.export as l63_export
+import contrib.lorenz63.models as l63_models
+import contrib.lorenz63.warm_start as l63_warm_start
+
+
+def timeit(fn, n_repeat=3):
+    """ Best wall-clock time (s) of `fn()` over `n_repeat` runs. """
+    best = np.inf
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(fn):
+    """ Peak memory (MiB) traced while running `fn()`. """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def bench_ensemble_integration(n_members=64, t_max=20., dt=0.01, seed=0):
+    """ Trajectories/second of the per-member `trajectory_da` loop vs the batched integrator. """
+    y0 = np.array([8., 0., 30.]) + np.random.default_rng(seed).normal(size=(n_members, 3))
+    solver_kw = dict(t_span=[dt, t_max + dt], t_eval=np.arange(dt, t_max + dt, dt), first_step=dt, method='RK45')
+    return {
+        'solve_ivp': n_members / timeit(lambda: [
+            l63_data.trajectory_da(l63_data.dyn_lorenz63, y, solver_kw) for y in y0
+        ], n_repeat=1),
+        **{
+            f'batch_{method.lower()}': n_members / timeit(lambda: l63_data.ensemble_trajectory_da(
+                l63_data.dyn_lorenz63, y0, {**solver_kw, 'method': method}
+            ))
+            for method in ['RK45', 'RK4']
+        },
+    }
+
+
+def bench_interpolation(n_times=(10**5, 10**6), n_rows=8, sample_step=20, seed=0):
+    """ Seconds to fill `n_rows` subsampled series: per-row `interpolate_grid_data` vs `interpolate_time_series`. """
+    results = {}
+    for n_time in n_times:
+        npa = np.full((n_rows, n_time), np.nan)
+        npa[:, ::sample_step] = np.random.default_rng(seed).normal(size=(n_rows, len(range(0, n_time, sample_step))))
+        results[n_time] = {
+            'griddata': timeit(lambda: [l63_data.interpolate_grid_data(row) for row in npa]),
+            **{
+                method: timeit(lambda: l63_data.interpolate_time_series(npa, method=method))
+                for method in ['linear', 'cubic', 'akima']
+            },
+        }
+    return results
+
+
+def bench_streaming_memory(n_time=10**5, chunk_sizes=(1000, 10000), sample_step=20):
+    """ Peak memory (MiB) of `training_da` vs consuming `iter_training_da` chunk by chunk. """
+    traj_da = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, [[8., 0., 30.]],
+        dict(t_span=[0., n_time * 0.01], first_step=0.01, method='RK4')
+    ).isel(member=0, time=slice(n_time))
+    obs_fn = lambda da: l63_data.subsample(l63_data.only_first_obs(da), sample_step=sample_step)
+
+    def consume(chunks):
+        for _ in chunks:
+            pass
+
+    return {
+        'full': peak_memory(lambda: l63_data.training_da(traj_da, obs_fn)),
+        **{
+            f'chunk_{chunk_size}': peak_memory(lambda: consume(
+                l63_data.iter_training_da(traj_da, obs_fn, chunk_size=chunk_size)
+            ))
+            for chunk_size in chunk_sizes
+        },
+    }
+
+
+def _lorenz_input_da(n_time=10000, sample_step=20, dt=0.01):
+    traj_da = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, [[8., 0., 30.]], dict(t_span=[0., n_time * dt], first_step=dt, method='RK4'),
+    ).isel(member=0, time=slice(n_time))
+    return l63_data.training_da(
+        traj_da, lambda da: l63_data.add_noise(l63_data.subsample(l63_data.only_first_obs(da), sample_step), 2.)
+    )
+
+
+def _lorenz_datamodule(input_da, patch_size=200, batch_size=128, **kwargs):
+    return l63_data.LorenzDataModule(
+        input_da, domains={k: {'time': slice(None)} for k in ['train', 'val', 'test']},
+        xrds_kw=dict(patch_dims={'variable': 3, 'component': 3, 'time': patch_size}, strides={'time': 1}),
+        dl_kw=dict(batch_size=batch_size), **kwargs,
+    )
+
+
+def _legacy_post_fn(dm):
+    normalize = lambda item: (item - dm.norm_stats()[0]) / dm.norm_stats()[1]
+    return ft.partial(ft.reduce, lambda i, f: f(i), [
+        l63_data.TrainingItemWithInit._make,
+        lambda item: item._replace(tgt=normalize(item.tgt)),
+        lambda item: item._replace(input=normalize(item.input)),
+        lambda item: item._replace(init=normalize(item.init)),
+    ])
+
+
+def loader_throughput(dataloader, n_batches=20):
+    """ Items/second drawn from `dataloader` over `n_batches` batches. """
+    start, n_items = time.perf_counter(), 0
+    for batch in itertools.islice(dataloader, n_batches):
+        n_items += len(batch[0])
+    return n_items / (time.perf_counter() - start)
+
+
+def bench_post_fn(n_items=4096, batch_size=128):
+    """
+    Items/second of the normalization and collation of raw items: chained `_replace` calls,
+    fused per-item `post_fn`, and batch-level `normalize_collate`. The xarray patch
+    extraction is excluded, see `loader_throughput` for end-to-end numbers.
+    """
+    dm = _lorenz_datamodule(_lorenz_input_da())
+    dm.setup()
+    raw_ds = src.data.XrDataset(dm.input_da, **dm.xrds_kw)
+    items = [raw_ds[i] for i in range(min(n_items, len(raw_ds)))]
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    mean, std = dm.norm_stats()
+    per_item = lambda post_fn: lambda: [
+        torch.utils.data.default_collate([post_fn(item) for item in batch]) for batch in batches
+    ]
+    return {
+        'reduce': len(items) / timeit(per_item(_legacy_post_fn(dm))),
+        'fused': len(items) / timeit(per_item(dm.post_fn())),
+        'collate': len(items) / timeit(lambda: [
+            l63_data.normalize_collate(batch, mean, std) for batch in batches
+        ]),
+    }
+
+
+def bench_generate_ensemble(n_members=32, workers=(1, 2, 4), t_max=50., dt=0.01):
+    """ Members/second of `generate_ensemble` for several numbers of worker processes. """
+    solver_kw = dict(t_span=[dt, t_max + dt], t_eval=np.arange(dt, t_max + dt, dt), first_step=dt, method='RK45')
+    obs_fn = toolz.compose_left(
+        l63_data.only_first_obs, ft.partial(l63_data.subsample, sample_step=20),
+        ft.partial(l63_data.add_noise, sigma=2.),
+    )
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_workers in workers:
+            results[n_workers] = n_members / timeit(lambda: l63_data.generate_ensemble(
+                n_members, l63_data.dyn_lorenz63, [8., 0., 30.], solver_kw, obs_fn,
+                workers=n_workers, path=os.path.join(tmp_dir, 'ensemble.npy'),
+            ), n_repeat=1)
+    return results
+
+
+def bench_rhs_jac(methods=('RK45', 'DOP853', 'LSODA', 'Radau'), t_max=20., dt=0.01):
+    """ Seconds per `trajectory_da` for each solver with the NumPy RHS, plus analytic Jacobian, plus compiled RHS. """
+    solver_kw = dict(t_span=[dt, t_max + dt], t_eval=np.arange(dt, t_max + dt, dt), first_step=dt,
+                     rtol=1e-6, atol=1e-9)
+    variants = {
+        'numpy': dict(fn=l63_data.dyn_lorenz63),
+        'numpy+jac': dict(fn=l63_data.dyn_lorenz63, jac=l63_data.jac_lorenz63),
+        'jit+jac': dict(fn=l63_data.dyn_lorenz63_jit, jac=l63_data.jac_lorenz63),
+    }
+    # trigger the compilation before timing
+    l63_data.dyn_lorenz63_jit(0., np.ones(3))
+    l63_data.jac_lorenz63(0., np.ones(3))
+    return {
+        method: {
+            name: timeit(lambda: l63_data.trajectory_da(
+                variant['fn'], [8., 0., 30.], {**solver_kw, 'method': method,
+                                               **({'jac': variant['jac']} if 'jac' in variant else {})}
+            ))
+            for name, variant in variants.items()
+        }
+        for method in methods
+    }
+
+
+def bench_observation_memory(n_time=10**6, sample_step=20, sigma=2.):
+    """
+    Peak memory of the observation chain in units of the trajectory size (i.e. number of
+    full-size float64 copies) and seconds per call: legacy chain vs `observe`.
+    """
+    traj_da = xr.DataArray(
+        np.random.default_rng(0).normal(size=(3, n_time)), dims=('component', 'time'),
+        coords={'component': ['x', 'y', 'z'], 'time': np.arange(n_time)},
+    )
+    legacy_fn = toolz.compose_left(
+        l63_data.only_first_obs, ft.partial(l63_data.subsample, sample_step=sample_step),
+        ft.partial(l63_data.add_noise, sigma=sigma),
+    )
+    observe_fn = l63_data.observation_fn(
+        l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=sample_step), sigma=sigma, rng=0,
+    )
+    size = traj_da.nbytes / 2**20
+    return {
+        name: {'copies': peak_memory(lambda: obs_fn(traj_da)) / size, 'seconds': timeit(lambda: obs_fn(traj_da))}
+        for name, obs_fn in [('legacy', legacy_fn), ('observe', observe_fn)]
+    }
+
+
+def bench_window_index(window_sizes=(50, 200, 1000), n_items=2000):
+    """ Items/second of raw item access: `XrDataset` vs `WindowXrDataset` for several window sizes. """
+    input_da = _lorenz_input_da(n_time=20000)
+    results = {}
+    for window in window_sizes:
+        xrds_kw = dict(patch_dims={'variable': 3, 'component': 3, 'time': window}, strides={'time': 1})
+        results[window] = {}
+        for name, ds_cls in [('xarray', src.data.XrDataset), ('window', l63_data.WindowXrDataset)]:
+            ds = ds_cls(input_da, **xrds_kw)
+            results[window][name] = n_items / timeit(lambda: [ds[i] for i in range(n_items)])
+    return results
+
+
+def bench_tensor_backend(batch_sizes=(32, 128, 512), n_batches=20):
+    """ Items/second of the train dataloader: xarray items vs the torch tensor backend. """
+    input_da = _lorenz_input_da(n_time=20000)
+    results = {}
+    for batch_size in batch_sizes:
+        results[batch_size] = {}
+        for name, kwargs in [
+            ('xarray', {}), ('window', dict(window_index=True)), ('tensor', dict(tensor_backend=True)),
+        ]:
+            dm = _lorenz_datamodule(input_da, batch_size=batch_size, norm_stats=(0., 1.), **kwargs)
+            dm.setup()
+            results[batch_size][name] = loader_throughput(dm.train_dataloader(), n_batches)
+    return results
+
+
+def _masked_batch(batch_size, patch_size, p=0.1):
+    """ Random (batch, component, time) targets observed with probability `p`, as a `TrainingItemWithInit`. """
+    tgt = torch.randn(batch_size, 3, patch_size)
+    inp = torch.where(torch.rand_like(tgt) < p, tgt, torch.full_like(tgt, float('nan')))
+    return l63_data.TrainingItemWithInit(input=inp, tgt=tgt, init=inp.nan_to_num())
+
+
+def _solver(n_step, patch_size=200, dim_hidden=32, prior_cost=None, obs_cost=None, grad_mod=None, **kwargs):
+    """ `SolverWithInit`, by default with untrained rearranged bilinear prior and ConvLSTM grad model. """
+    if prior_cost is None:
+        prior_cost = l63_models.RearrangedBilinAEPriorCost(dim_in=patch_size, dim_hidden=dim_hidden)
+    return l63_models.SolverWithInit(
+        prior_cost=prior_cost,
+        obs_cost=src.models.BaseObsCost() if obs_cost is None else obs_cost,
+        grad_mod=l63_models.RearrangedConvLstmGradModel(dim_in=patch_size, dim_hidden=dim_hidden)
+        if grad_mod is None else grad_mod,
+        n_step=n_step, **kwargs,
+    )
+
+
+def bench_multi_prior(n_priors=(4, 8), batch_size=32, patch_size=200, dim_hidden=32):
+    """ Seconds per prior cost + gradient evaluation (as in a solver step): looped vs fused `MultiPrior`. """
+    results = {}
+    x = torch.randn(batch_size, 3, patch_size, requires_grad=True)
+    for n_prior in n_priors:
+        priors = [
+            l63_models.RearrangedBilinAEPriorCost(dim_in=patch_size, dim_hidden=dim_hidden) for _ in range(n_prior)
+        ]
+
+        def step(multi_prior):
+            torch.autograd.grad(multi_prior(x), x, create_graph=True)
+
+        results[n_prior] = {
+            name: timeit(ft.partial(step, l63_models.MultiPrior(*priors, fused=name == 'fused')))
+            for name in ['loop', 'fused']
+        }
+    return results
+
+
+def bench_solver_layout(batch_size=32, patch_size=200, dim_hidden=32, n_step=5):
+    """
+    Per `GradSolver` step: copy/permute ops (from the torch profiler) and seconds of a training
+    forward + backward, rearranging at every prior/grad model call vs once around the loop.
+    """
+    batch = _masked_batch(batch_size, patch_size)
+    results = {}
+    for name, kw in [('per_call', {}), ('once', dict(rearrange_from='b c t', rearrange_to='b t c ()'))]:
+        solver = _solver(n_step, patch_size, dim_hidden, **kw)
+
+        def step(solver=solver):
+            solver(batch).sum().backward()
+
+        with torch.profiler.profile() as prof:
+            step()
+        ops = collections.Counter(evt.name for evt in prof.events())
+        results[name] = dict(
+            {op: ops[op] / n_step for op in ['aten::copy_', 'aten::permute', 'aten::contiguous']},
+            seconds=timeit(step) / n_step,
+        )
+    return results
+
+
+def bench_conv1d(batch_size=32, patch_size=200, dim_hidden=32):
+    """
+    FLOPs (from `FlopCounterMode`) and seconds of one prior cost + gradient and one grad model
+    call (as in a solver step): rearranged `Conv2d` models vs their `Conv1d` counterparts.
+    """
+    x = torch.randn(batch_size, 3, patch_size, requires_grad=True)
+    results = {}
+    for name, prior_cls, grad_cls in [
+        ('conv2d', l63_models.RearrangedBilinAEPriorCost, l63_models.RearrangedConvLstmGradModel),
+        ('conv1d', l63_models.Conv1dBilinAEPriorCost, l63_models.Conv1dConvLstmGradModel),
+    ]:
+        prior = prior_cls(dim_in=patch_size, dim_hidden=dim_hidden)
+        grad_mod = grad_cls(dim_in=patch_size, dim_hidden=dim_hidden)
+
+        def step(prior=prior, grad_mod=grad_mod):
+            state = x * 1  # non-leaf state, as inside the solver loop
+            grad_mod.reset_state(state)
+            grad_mod(torch.autograd.grad(prior(state), state, create_graph=True)[0])
+
+        with torch.utils.flop_counter.FlopCounterMode(display=False) as flop_counter:
+            step()
+        results[name] = dict(flops=flop_counter.get_total_flops(), seconds=timeit(step))
+    return results
+
+
+def _legacy_lit_step(lit, batch, phase='train'):
+    """ `LitLorenz.step` before the prior cost reuse: prior evaluated again, Sobel loss discarded. """
+    loss, out = lit.base_step(batch, phase)
+    prior_cost = lit.solver.prior_cost(lit.solver.init_state(batch, out))
+    lit.weighted_mse(
+        kfilts.sobel(out[..., None]).squeeze() - kfilts.sobel(batch.tgt[..., None]).squeeze(), lit.rec_weight
+    )
+    return loss + prior_cost, out
+
+
+def bench_lit_step(batch_size=32, patch_size=200, dim_hidden=32, n_step=5):
+    """ Seconds of a `LitLorenz` training step (forward + backward): legacy step vs prior cost reuse. """
+    batch = _masked_batch(batch_size, patch_size)
+    lit = l63_models.LitLorenz(
+        _solver(n_step, patch_size, dim_hidden),
+        rec_weight=np.ones((3, patch_size), dtype=np.float32), opt_fn=None, norm_stats=(0., 1.),
+        reuse_prior_cost=True,
+    )
+
+    def step(step_fn):
+        step_fn(batch, 'train')[0].backward()
+
+    return dict(
+        solver_forward=timeit(ft.partial(lit.base_step, batch, 'train')),
+        legacy=timeit(ft.partial(step, ft.partial(_legacy_lit_step, lit))),
+        reuse=timeit(ft.partial(step, lit.step)),
+    )
+
+
+def bench_metrics(n_times=(10**5, 10**6)):
+    """ Seconds to evaluate a reconstructed test set: legacy xarray `mse` + `percent_err` vs all `rec_metrics`. """
+    results = {}
+    for n_time in n_times:
+        tgt = np.random.randn(3, n_time)
+        rec_ds = xr.Dataset({
+            'tgt': (('component', 'time'), tgt), 'out': (('component', 'time'), tgt + np.random.randn(3, n_time))
+        })
+
+        def legacy():
+            ((rec_ds.tgt - rec_ds.out)**2).mean().values.item()
+            (np.mean((rec_ds.tgt - rec_ds.out)**2)/np.mean(rec_ds.tgt**2)).mean().values.item()
+
+        def legacy_all():
+            """ Same metrics as `rec_metrics`, each with its own xarray traversal. """
+            legacy()
+            np.sqrt(((rec_ds.tgt - rec_ds.out)**2).mean()).values.item()
+            ((rec_ds.tgt - rec_ds.out)**2).mean('time').values
+            (((rec_ds.tgt - rec_ds.out)**2).mean('time') / (rec_ds.tgt**2).mean('time')).values
+            ((rec_ds.tgt - rec_ds.out)**2).mean('component').values
+            (
+                (np.abs(np.fft.rfft((rec_ds.out - rec_ds.tgt).values))**2).sum(0)
+                / (np.abs(np.fft.rfft(rec_ds.tgt.values))**2).sum(0)
+            )
+
+        results[n_time] = dict(
+            legacy=timeit(legacy), legacy_all=timeit(legacy_all),
+            rec_metrics=timeit(ft.partial(l63_models.rec_metrics, rec_ds)),
+        )
+    return results
+
+
+def _solver_train_step(n_step, batch_size, patch_size, dim_hidden, dyn_cost=None, **solver_kw):
+    """ Peak RSS increase (bytes) and seconds of a solver forward + backward, run in a fresh process. """
+    import resource  # pylint: disable=import-outside-toplevel
+
+    torch.manual_seed(0)
+    batch = _masked_batch(batch_size, patch_size)
+    prior = l63_models.RearrangedBilinAEPriorCost(dim_in=patch_size, dim_hidden=dim_hidden)
+    solver = _solver(
+        n_step, patch_size, dim_hidden,
+        prior_cost=prior if dyn_cost is None else l63_models.DynRegularizedPrior(prior, dyn_cost), **solver_kw,
+    )
+
+    def step():
+        (solver(batch).pow(2).mean() + solver.prior_costs[-1]).backward()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    step()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    return dict(peak_rss_mb=rss / 2**10, seconds=timeit(step))
+
+
+def bench_solver_memory(n_steps=(5, 15), batch_size=128, patch_size=200, dim_hidden=32):
+    """ Peak memory and seconds of a training step: full backprop vs checkpointed vs truncated (last 2 steps). """
+    configs = dict(full={}, checkpoint=dict(grad_checkpoint=True), truncated=dict(n_step_grad=2))
+    results = {}
+    for n_step, (name, solver_kw) in itertools.product(n_steps, configs.items()):
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results[n_step, name] = pool.submit(
+                _solver_train_step, n_step, batch_size, patch_size, dim_hidden, **solver_kw
+            ).result()
+    return results
+
+
+class _SmoothnessPrior(torch.nn.Module):
+    """ Quadratic second order time difference prior, with a fixed point for `forward_ae`. """
+    def __init__(self, alpha=1.):
+        super().__init__()
+        self.alpha = alpha
+
+    def forward_ae(self, x):
+        return x
+
+    def forward(self, state):
+        return self.alpha / 2 * state.diff(n=2, dim=-1).pow(2).sum()
+
+
+class _SumObsCost(torch.nn.Module):
+    def forward(self, state, batch):
+        msk = batch.input.isfinite()
+        return ((state - batch.input.nan_to_num())**2 * msk).sum() / 2
+
+
+class _NoGradModel(torch.nn.Module):
+    """ Plain gradient descent: no learned correction. """
+    def reset_state(self, inp):
+        pass
+
+    def forward(self, x):
+        return torch.zeros_like(x)
+
+
+def bench_warm_start(n_steps=(4, 16, 64, 256), n_epochs=3, tol=0.5, alpha=1., batch_size=32):
+    """
+    Iterations-to-tolerance of a gradient descent `SolverWithInit` (quadratic smoothness prior,
+    all components observed every 4 steps), without warm start and after `n_epochs` epochs with
+    a `WarmStartStore`: the smallest number of solver iterations whose distance to the converged
+    solution is below `tol` times the distance of `batch.init`.
+    """
+    traj_da = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, [[8., 0., 30.]], dict(t_span=[0., 20.], first_step=0.01, method='RK4'),
+    ).isel(member=0, time=slice(2000))
+    input_da = l63_data.training_da(traj_da, lambda da: l63_data.add_noise(l63_data.subsample(da, 4), 2.))
+    dm = _lorenz_datamodule(input_da, batch_size=batch_size, with_index=True)
+    dm.setup()
+    batch = next(iter(dm.train_dataloader()))
+
+    def solver(n_step, warm_start=None):
+        return _solver(
+            n_step, prior_cost=_SmoothnessPrior(alpha), obs_cost=_SumObsCost(), grad_mod=_NoGradModel(),
+            lr_grad=1 / (1 + 16 * alpha), warm_start=warm_start,
+        )
+
+    ref = solver(5000)(batch).detach()
+    init_dist = (batch.init.nan_to_num() - ref).norm()
+    residuals = {}
+    for n_step in n_steps:
+        cold = solver(n_step)(batch).detach()
+        warm_solver = solver(n_step, l63_warm_start.WarmStartStore())
+        for _ in range(n_epochs):
+            warm = warm_solver(batch).detach()
+        residuals[n_step] = dict(
+            cold=((cold - ref).norm() / init_dist).item(), warm=((warm - ref).norm() / init_dist).item()
+        )
+    return dict(
+        iterations_to_tol={
+            name: min([n for n in n_steps if residuals[n][name] < tol], default=None) for name in ['cold', 'warm']
+        },
+        residuals=residuals,
+    )
+
+
+def bench_early_stopping(tols=(None, 1e-2, 3e-3), n_step=50, min_step=10, batch_size=128, patch_size=200,
+                         dim_hidden=32):
+    """
+    Inference milliseconds per sample and mean solver iterations: fixed iterations vs early
+    stopping. The solver is a plain gradient descent on an (untrained) autoencoder prior and
+    the observation cost (batch means, so the step is scaled by the batch size). Every other
+    sample of the batch starts from an already converged state, e.g. a warm start.
+    """
+    dm = _lorenz_datamodule(_lorenz_input_da(n_time=2000), patch_size=patch_size, batch_size=batch_size)
+    dm.setup()
+    batch = next(iter(dm.test_dataloader()))
+    torch.manual_seed(0)
+    prior_cost = l63_models.RearrangedBilinAEPriorCost(dim_in=patch_size, dim_hidden=dim_hidden)
+
+    def solver(tol, n_step=n_step):
+        return _solver(
+            n_step, prior_cost=prior_cost, grad_mod=_NoGradModel(),
+            lr_grad=0.02 * batch.input.numel(), early_stop_tol=tol, early_stop_min_step=min_step,
+        ).eval()
+
+    init = batch.init.nan_to_num()
+    init[::2] = solver(None, n_step=4 * n_step)(batch)[::2].detach()
+    batch = batch._replace(init=init)
+    results = {}
+    for tol in tols:
+        early_stop_solver = solver(tol)
+        results[tol] = dict(
+            ms_per_sample=timeit(ft.partial(early_stop_solver, batch)) / batch_size * 1e3,
+            mean_iter=n_step if tol is None else early_stop_solver.n_iter.float().mean().item(),
+        )
+    return results
+
+
+def bench_export(batch_sizes=(1, 32), n_step=10, patch_size=200, dim_hidden=32, n_priors=2):
+    """ Load seconds of the TorchScript artifact and inference seconds: eager `SolverWithInit` vs exported. """
+    torch.manual_seed(0)
+    solver = _solver(n_step, patch_size, dim_hidden, prior_cost=l63_models.MultiPrior(*[
+        l63_models.RearrangedBilinAEPriorCost(dim_in=patch_size, dim_hidden=dim_hidden) for _ in range(n_priors)
+    ])).eval()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'solver.pt')
+        l63_export.export_solver(solver, path)
+        results = dict(load=timeit(ft.partial(l63_export.load_solver, path)))
+        exported = l63_export.load_solver(path)
+    for batch_size in batch_sizes:
+        batch = _masked_batch(batch_size, patch_size)
+        exported(batch.input, batch.init)  # profiling runs of the TorchScript executor
+        exported(batch.input, batch.init)
+        results[batch_size] = dict(
+            eager=timeit(ft.partial(solver, batch), n_repeat=10),
+            exported=timeit(ft.partial(exported, batch.input, batch.init), n_repeat=10),
+        )
+    return results
+
+
+def bench_attractor_bank(warmup_lengths=(5., 20., 50.), n_trajectories=16, n_states=1000, t_max=20., dt=0.01):
+    """ Seconds to generate `n_trajectories` trajectories: spin-up of each one vs draws from an attractor bank. """
+    solver_kw = dict(t_span=[dt, t_max + dt], t_eval=np.arange(dt, t_max + dt, dt), first_step=dt, method='RK45')
+    y0 = np.array([8., 0., 30.]) + np.random.default_rng(0).normal(size=(n_trajectories, 3))
+    results = {}
+    for warmup in warmup_lengths:
+        warmup_kw = dict(t_span=[0., warmup], t_eval=None)
+        bank_time = timeit(ft.partial(
+            l63_data.attractor_bank, l63_data.dyn_lorenz63, n_states, solver_kw, warmup_kw
+        ), n_repeat=1)
+        bank = l63_data.attractor_bank(l63_data.dyn_lorenz63, n_states, solver_kw, warmup_kw)
+        results[warmup] = dict(
+            spin_up=timeit(lambda: [
+                l63_data.trajectory_da(l63_data.dyn_lorenz63, y, solver_kw, warmup_kw) for y in y0
+            ], n_repeat=1),
+            bank=timeit(lambda: [
+                l63_data.trajectory_da(l63_data.dyn_lorenz63, None, solver_kw, bank=bank, seed=seed)
+                for seed in range(n_trajectories)
+            ], n_repeat=1),
+            bank_generation=bank_time,
+        )
+    return results
+
+
+def _nbytes(obj):
+    return sum(_nbytes(v) for v in obj) if isinstance(obj, tuple) else getattr(obj, 'nbytes', 0)
+
+
+def bench_sparse_obs(sample_steps=(1, 5, 20, 100), n_time=10**5, patch_size=200, batch_size=128):
+    """
+    MiB of the dataset arrays, peak MiB while building them and MiB of the input of a batch:
+    NaN-dense `training_da` vs `sparse_training_da` (x observed every `sample_step`).
+    """
+    traj_da = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, [[8., 0., 30.]], dict(t_span=[0., n_time * 0.01], first_step=0.01, method='RK4'),
+    ).isel(member=0, time=slice(n_time))
+    results = {}
+    for sample_step in sample_steps:
+        obs_fn = l63_data.observation_fn(
+            l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=sample_step),
+            sigma=2., rng=0,
+        )
+        sparse_obs_fn = l63_data.observation_fn(
+            l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=sample_step),
+            sigma=2., rng=0, sparse=True,
+        )
+        input_da = l63_data.training_da(traj_da, obs_fn)
+        dense_da, obs = l63_data.sparse_training_da(traj_da, sparse_obs_fn)
+        dm = _lorenz_datamodule(input_da, patch_size=patch_size, batch_size=batch_size)
+        dm_sparse = l63_data.LorenzDataModule(
+            dense_da, obs=obs, domains={k: {'time': slice(None)} for k in ['train', 'val', 'test']},
+            xrds_kw=dict(patch_dims={'variable': 2, 'component': 3, 'time': patch_size}, strides={'time': 1}),
+            dl_kw=dict(batch_size=batch_size),
+        )
+        dm.setup()
+        dm_sparse.setup()
+        results[sample_step] = dict(
+            dense_data=input_da.nbytes / 2**20,
+            sparse_data=(dense_da.nbytes + _nbytes(obs)) / 2**20,
+            dense_peak=peak_memory(lambda: l63_data.training_da(traj_da, obs_fn)),
+            sparse_peak=peak_memory(lambda: l63_data.sparse_training_da(traj_da, sparse_obs_fn)),
+            dense_batch_input=_nbytes(next(iter(dm.train_dataloader())).input) / 2**20,
+            sparse_batch_input=_nbytes(next(iter(dm_sparse.train_dataloader())).input) / 2**20,
+        )
+    return results
+
+
+def bench_on_the_fly(num_workers=(0, 1, 2), batch_size=128, patch_size=200, margin=20, n_batches=10,
+                     n_step=5, dim_hidden=32, dt=0.01):
+    """
+    Samples/second of the on-the-fly training loader per number of workers, against the
+    samples/second consumed by a CPU solver training step.
+    """
+    n_eval = patch_size + 2 * margin
+    solver_kw = dict(t_span=[0., n_eval * dt], t_eval=np.arange(n_eval) * dt, first_step=dt, method='RK4')
+    bank = l63_data.attractor_bank(l63_data.dyn_lorenz63, 1000, solver_kw, dict(t_span=[0., 20.], t_eval=None))
+    on_the_fly_kw = dict(
+        fn=l63_data.dyn_lorenz63, solver_kw=solver_kw, bank=bank, margin=margin, n_batches=n_batches,
+        obs_fn=l63_data.observation_fn(
+            l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=20), sigma=2.,
+        ),
+    )
+    results = {'train_step': batch_size / _solver_train_step(n_step, batch_size, patch_size, dim_hidden)['seconds']}
+    for workers in num_workers:
+        dm = _lorenz_datamodule(_lorenz_input_da(), patch_size=patch_size, batch_size=batch_size,
+                                on_the_fly_kw=on_the_fly_kw)
+        dm.dl_kw = {**dm.dl_kw, 'num_workers': workers}
+        dm.setup()
+        results[f'workers_{workers}'] = loader_throughput(dm.train_dataloader(), n_batches)
+    return results
+
+
+def bench_dyn_cost(n_subs=(1, 4), batch_size=128, patch_size=200, dim_hidden=32, n_step=5):
+    """
+    Seconds of a cost + gradient evaluation (one solver iteration's worth of prior cost):
+    learned bilinear prior vs `LorenzDynCost`, and of a training step of the solver without
+    and with the dynamics term.
+    """
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, patch_size, 3, 1, requires_grad=True)
+    prior = l63_models.RearrangedBilinAEPriorCost(dim_in=patch_size, dim_hidden=dim_hidden)
+    cost_grad = lambda cost: lambda: torch.autograd.grad(cost(x), x, create_graph=True)
+    results = dict(learned_prior=timeit(cost_grad(prior), n_repeat=10))
+    for n_sub in n_subs:
+        results[f'dyn_cost_{n_sub}'] = timeit(cost_grad(l63_models.LorenzDynCost(n_sub=n_sub)), n_repeat=10)
+    results['train_step'] = _solver_train_step(n_step, batch_size, patch_size, dim_hidden)['seconds']
+    results['train_step_dyn'] = _solver_train_step(
+        n_step, batch_size, patch_size, dim_hidden, dyn_cost=l63_models.LorenzDynCost()
+    )['seconds']
+    return results
+
+
+def bench_baselines(batch_size=64, patch_size=200, n_members=(16, 64), sample_step=20, obs_sigma=2**.5,
+                    background_sigma=1., n_step=10, dim_hidden=32, solver=None, seed=0, dt=0.01):
+    """
+    `mse`, `percent_err` and seconds per window of the classical baselines and of 4DVarNet
+    inference on a batch of windows drawn from the attractor, x observed every `sample_step`.
+
+    The baselines start from the true initial states perturbed by `background_sigma`. `solver`
+    is the (trained) `SolverWithInit` of a `LitLorenz` model, a randomly initialized one is used
+    by default, whose accuracy is meaningless but timing representative.
+    """
+    solver_kw = dict(t_span=[0., (patch_size - 1) * dt], t_eval=np.arange(patch_size) * dt,
+                     first_step=dt, method='RK4')
+    bank = l63_data.attractor_bank(l63_data.dyn_lorenz63, 10 * batch_size, solver_kw,
+                                   dict(t_span=[0., 20.], t_eval=None), seed=seed)
+    traj_da = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, l63_data.sample_attractor_states(bank, batch_size, seed=seed), solver_kw
+    )
+    input_da = l63_data.training_da(traj_da, l63_data.observation_fn(
+        l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=sample_step),
+        sigma=obs_sigma, rng=seed,
+    ))
+    tgt, obs, init = (torch.from_numpy(input_da.sel(variable=v).values) for v in ('tgt', 'input', 'init'))
+    background = tgt[..., 0] + background_sigma * torch.randn(tgt[..., 0].shape, dtype=tgt.dtype,
+                                                              generator=torch.Generator().manual_seed(seed))
+
+    def evaluate(run):
+        start = time.perf_counter()
+        out = run()
+        seconds = time.perf_counter() - start
+        scores = l63_models.metrics(out, tgt)
+        return dict(
+            mse=scores.mse.item(), percent_err=scores.percent_err.item(), seconds_per_window=seconds / batch_size
+        )
+
+    baseline_kw = dict(dt=dt, obs_sigma=obs_sigma, background_sigma=background_sigma)
+    results = {'4dvar': evaluate(lambda: l63_baselines.fourdvar(obs, background, **baseline_kw))}
+    for members in n_members:
+        results[f'enkf_{members}'] = evaluate(
+            lambda: l63_baselines.enkf(obs, background, n_members=members, seed=seed, **baseline_kw)
+        )
+
+    if solver is None:
+        torch.manual_seed(seed)
+        solver = _solver(n_step, patch_size, dim_hidden)
+    mean, std = tgt.mean().item(), tgt.std().item()
+    batch = l63_data.TrainingItemWithInit(*((t.float() - mean) / std for t in (init, obs, tgt)))
+    results['4dvarnet'] = evaluate(lambda: solver.eval()(batch).detach().double() * std + mean)
+    return results
+
+
+if __name__ == '__main__':
+    for name, bench in list(globals().items()):
+        if name.startswith('bench_'):
+            print(name, bench())
@@ -0,0 +1,214 @@
+"""
+On-disk cache of generated Lorenz-63 training datasets.
+
+Entries are content-addressed by a hash of the generation parameters (dynamical model,
+initial state, solver and warmup keywords, observation function chain, noise seed and
+interpolation method). Each entry stores the `training_da` array as a `.npy` file next
+to a `meta.json` file holding its dims and coords; cached arrays are memory-mapped on
+load so that startup does not pay the preprocessing again.
+
+Usage:
+    python -m contrib.lorenz63.cache [--dir CACHE_DIR] ls
+    python -m contrib.lorenz63.cache [--dir CACHE_DIR] purge [KEY ...]
+    python -m contrib.lorenz63.cache [--dir CACHE_DIR] evict MAX_SIZE_MB
+"""
+
+import argparse
+import collections.abc
+import functools as ft
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import numpy as np
+import xarray as xr
+import contrib.lorenz63.data as l63_data
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'LORENZ63_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'lorenz63')
+)
+
+
+def describe(obj):
+    """
+    Build a JSON-serializable description of generation parameters.
+
+    Functions are described by their qualified name (and bytecode for lambdas), partials
+    and `toolz` compositions recursively by their parts, arrays by a digest of their data and
+    random generators by their state. Objects only described by their address raise a `TypeError`.
+    """
+    if isinstance(obj, ft.partial):
+        return {'partial': describe(obj.func), 'args': describe(obj.args), 'kw': describe(obj.keywords)}
+    if hasattr(obj, 'first') and hasattr(obj, 'funcs'):
+        return {'compose': [describe(fn) for fn in (obj.first, *obj.funcs)]}
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        desc = f"{getattr(obj, '__module__', '')}.{obj.__qualname__}"
+        if '<lambda>' in obj.__qualname__ and hasattr(obj, '__code__'):
+            code = obj.__code__.co_code + repr(obj.__code__.co_consts).encode()
+            desc += '#' + hashlib.sha256(code).hexdigest()[:16]
+            if obj.__closure__:
+                return {'lambda': desc, 'closure': [describe(cell.cell_contents) for cell in obj.__closure__]}
+        return desc
+    if isinstance(obj, str) or obj is None or isinstance(obj, (bool, int, float)):
+        return obj
+    if isinstance(obj, collections.abc.Mapping):
+        return {str(k): describe(v) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(obj, collections.abc.Sequence):
+        return [describe(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        return {'array': hashlib.sha256(arr.tobytes()).hexdigest(), 'shape': arr.shape, 'dtype': str(arr.dtype)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (np.random.Generator, np.random.BitGenerator)):
+        bit_generator = getattr(obj, 'bit_generator', obj)
+        return {'bit_generator': describe(bit_generator.state)}
+    desc = repr(obj)
+    if re.search(r' at 0x[0-9a-fA-F]+', desc):
+        raise TypeError(f"Cannot describe {type(obj).__name__} by value for the cache key: {desc}")
+    return desc
+
+
+def cache_key(**params):
+    """ Content hash of the generation parameters. """
+    return hashlib.sha256(json.dumps(describe(params), sort_keys=True).encode()).hexdigest()[:32]
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def list_entries(cache_dir=DEFAULT_CACHE_DIR):
+    """ Cache entries as dicts (key, size, last_access, params) sorted from least to most recently used. """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if not os.path.isfile(os.path.join(path, 'meta.json')):
+            continue
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        entries.append(dict(
+            key=key, size=_entry_size(path),
+            last_access=os.path.getmtime(os.path.join(path, 'data.npy')), params=meta['params'],
+        ))
+    return sorted(entries, key=lambda e: e['last_access'])
+
+
+def purge(keys=None, cache_dir=DEFAULT_CACHE_DIR):
+    """ Remove the given entries (all entries by default), returns the removed keys. """
+    keys = [e['key'] for e in list_entries(cache_dir)] if keys is None else list(keys)
+    for key in keys:
+        shutil.rmtree(os.path.join(cache_dir, os.path.basename(key)), ignore_errors=True)
+    return keys
+
+
+def evict(max_size, cache_dir=DEFAULT_CACHE_DIR, keep=()):
+    """ Remove least recently used entries (except `keep`) until the cache holds at most `max_size` bytes. """
+    entries = list_entries(cache_dir)
+    total = sum(e['size'] for e in entries)
+    evicted = []
+    for entry in entries:
+        if total <= max_size:
+            break
+        if entry['key'] in keep:
+            continue
+        total -= entry['size']
+        evicted += purge([entry['key']], cache_dir)
+    return evicted
+
+
+def save_da(da, path, params=None):
+    """ Atomically write `da` as a cache entry directory. """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    np.save(os.path.join(tmp_path, 'data.npy'), da.values)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(
+            dims=list(da.dims),
+            coords={dim: da[dim].values.tolist() for dim in da.dims if dim in da.coords},
+            params=params,
+            created=time.time(),
+        ), f)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process wrote the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_da(path, mmap_mode='r'):
+    """ Load a cache entry as a memory-mapped DataArray and mark it as recently used. """
+    with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    os.utime(os.path.join(path, 'data.npy'))
+    return xr.DataArray(
+        np.load(os.path.join(path, 'data.npy'), mmap_mode=mmap_mode),
+        dims=meta['dims'], coords=meta['coords'],
+    )
+
+
+def cached_training_da(fn, y0, solver_kw, obs_fn, warmup_kw=None, seed=None, interp_method='cubic',
+                       cache_dir=DEFAULT_CACHE_DIR, max_size=None):
+    """
+    `training_da(trajectory_da(...), obs_fn)` read from the cache when available.
+
+    Args:
+        fn, y0, solver_kw, warmup_kw: Arguments of `trajectory_da`.
+        obs_fn, interp_method: Arguments of `training_da`.
+        seed (int, optional): Seed of the global NumPy random state used by `add_noise`, restored
+            afterwards. When None the noise is not reproducible and the first cached realization is reused.
+        cache_dir (str): Cache directory.
+        max_size (int, optional): Maximum cache size in bytes, least recently used entries are
+            evicted after a new entry is written.
+
+    Returns:
+        xr.DataArray: The (memory-mapped) training array.
+    """
+    params = dict(fn=fn, y0=np.asarray(y0), solver_kw=solver_kw, warmup_kw=warmup_kw,
+                  obs_fn=obs_fn, seed=seed, interp_method=interp_method)
+    key = cache_key(**params)
+    path = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(path, 'data.npy')):
+        with l63_data.global_seed(seed):
+            da = l63_data.training_da(
+                l63_data.trajectory_da(fn, y0, solver_kw, warmup_kw), obs_fn, interp_method=interp_method
+            )
+        save_da(da, path, params=describe(params))
+        if max_size is not None:
+            evict(max_size, cache_dir, keep=(key,))
+    return load_da(path)
+
+
+def main(argv=None):
+    """ Command line interface to inspect and purge the cache. """
+    parser = argparse.ArgumentParser(description="Inspect and purge the lorenz63 dataset cache")
+    parser.add_argument('--dir', default=DEFAULT_CACHE_DIR, help="cache directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('ls', help="list entries from least to most recently used")
+    purge_parser = commands.add_parser('purge', help="remove entries (all entries if no key is given)")
+    purge_parser.add_argument('keys', nargs='*')
+    evict_parser = commands.add_parser('evict', help="remove least recently used entries above a size")
+    evict_parser.add_argument('max_size_mb', type=float)
+    args = parser.parse_args(argv)
+
+    if args.command == 'ls':
+        entries = list_entries(args.dir)
+        for entry in entries:
+            last_access = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_access']))
+            print(f"{entry['key']}  {entry['size'] / 2**20:10.2f} MB  {last_access}")
+        print(f"{len(entries)} entries, {sum(e['size'] for e in entries) / 2**20:.2f} MB in {args.dir}")
+    elif args.command == 'purge':
+        removed = purge(args.keys or None, args.dir)
+        print(f"Removed {len(removed)} entries from {args.dir}")
+    elif args.command == 'evict':
+        removed = evict(args.max_size_mb * 2**20, args.dir)
+        print(f"Evicted {len(removed)} entries from {args.dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,34 @@ import xarray as xr
 from scipy.integrate import solve_ivp
 import scipy.interpolate
 import collections
+import contextlib
+import concurrent.futures
+import itertools
+import os
+import tempfile
+import weakref
+import torch
 import src.data
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 TrainingItemWithInit = collections.namedtuple(
     "TrainingItemWithInit", sorted(["init", "input", "tgt"])
 )
 
+IndexedTrainingItem = collections.namedtuple(
+    "IndexedTrainingItem", [*TrainingItemWithInit._fields, "idx"]
+)
+
+SparseObs = collections.namedtuple("SparseObs", ["index", "values", "shape"])
+SparseObs.__doc__ = """
+Observations as an (n_dims, n_obs) integer `index` into a dense array of `shape`, missing
+everywhere else, and their (n_obs,) `values` (NumPy arrays or torch tensors).
+"""
+
 def dyn_lorenz63(t, x, sigma=10., rho=28., beta=8./3):
     """ Lorenz-63 dynamical model. """
     x_1 = sigma*(x[1]-x[0])
@@ -19,7 +41,48 @@ def dyn_lorenz63(t, x, sigma=10., rho=28., beta=8./3):
     return dx
 
 
-def trajectory_da(fn, y0, solver_kw, warmup_kw=None):
+def _dyn_lorenz63_kernel(t, x, sigma, rho, beta):
+    dx = np.empty_like(x)
+    dx[0] = sigma*(x[1]-x[0])
+    dx[1] = x[0]*(rho-x[2])-x[1]
+    dx[2] = x[0]*x[1] - beta*x[2]
+    return dx
+
+
+def _jac_lorenz63_kernel(t, x, sigma, rho, beta):
+    jac = np.zeros((3, 3))
+    jac[0, 0], jac[0, 1] = -sigma, sigma
+    jac[1, 0], jac[1, 1], jac[1, 2] = rho - x[2], -1., -x[0]
+    jac[2, 0], jac[2, 1], jac[2, 2] = x[1], x[0], -beta
+    return jac
+
+
+if numba is not None:
+    # parameters are passed explicitly: numba dispatch on omitted default arguments is slow
+    _dyn_lorenz63_kernel = numba.njit(cache=True)(_dyn_lorenz63_kernel)
+    _jac_lorenz63_kernel = numba.njit(cache=True)(_jac_lorenz63_kernel)
+
+
+def dyn_lorenz63_jit(t, x, sigma=10., rho=28., beta=8./3):
+    """ Lorenz-63 dynamical model compiled with numba when available (NumPy otherwise). """
+    return _dyn_lorenz63_kernel(t, x, sigma, rho, beta)
+
+
+def jac_lorenz63(t, x, sigma=10., rho=28., beta=8./3):
+    """ Analytic Jacobian of `dyn_lorenz63`, to pass as `jac` in `solver_kw` for implicit solvers. """
+    return _jac_lorenz63_kernel(t, x, sigma, rho, beta)
+
+
+def trajectory_da(fn, y0, solver_kw, warmup_kw=None, bank=None, seed=None):
+    """
+    Integrate `fn` from `y0`, after a spin-up integration with `warmup_kw` when given.
+
+    With an attractor `bank` (see `attractor_bank`), the initial state is drawn from the bank
+    with `seed` instead: `y0` must then be None and `warmup_kw` is not allowed.
+    """
+    if bank is not None:
+        _check_bank_args(y0, warmup_kw)
+        y0 = sample_attractor_states(bank, seed=seed)
     if warmup_kw is not None:
         warmup = solve_ivp(fn, y0=y0, **{**solver_kw, **warmup_kw})
         y0 = warmup.y[:,-1]
@@ -27,6 +90,185 @@ def trajectory_da(fn, y0, solver_kw, warmup_kw=None):
     return xr.DataArray(warmup.y, dims=('component', 'time'), coords={'component': ['x', 'y', 'z'], 'time': warmup.t})
 
 
+BatchSolution = collections.namedtuple("BatchSolution", ["t", "y"])
+
+# Dormand-Prince 5(4) tableau, same scheme as scipy's RK45
+_DP_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+_DP_A = [
+    [],
+    [1/5],
+    [3/40, 9/40],
+    [44/45, -56/15, 32/9],
+    [19372/6561, -25360/2187, 64448/6561, -212/729],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+]
+_DP_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+_DP_E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+
+
+def _rk4_step(fn, t, y, dt):
+    k1 = fn(t, y)
+    k2 = fn(t + dt/2, y + dt/2 * k1)
+    k3 = fn(t + dt/2, y + dt/2 * k2)
+    k4 = fn(t + dt, y + dt * k3)
+    return y + dt/6 * (k1 + 2*k2 + 2*k3 + k4)
+
+
+def _rk45_step(fn, t, y, dt, k1):
+    ks = [k1]
+    for c, a in zip(_DP_C[1:], _DP_A[1:]):
+        ks.append(fn(t + c*dt, y + dt * sum(a_i * k for a_i, k in zip(a, ks))))
+    y_new = y + dt * sum(b * k for b, k in zip(_DP_B, ks))
+    ks.append(fn(t + dt, y_new))
+    err = dt * sum(e * k for e, k in zip(_DP_E, ks))
+    return y_new, err, ks[-1]
+
+
+def _solve_rk4(fn, t_span, y0, t_eval, dt):
+    t0, t1 = t_span
+    if t_eval is None:
+        t_eval = t0 + dt * np.arange(int(np.round((t1 - t0) / dt)) + 1)
+    t, y, ys = t0, y0, []
+    for t_next in t_eval:
+        # equal sub-steps no larger than dt so that every stored time is hit exactly
+        n_sub = int(np.ceil((t_next - t) / dt - 1e-9))
+        h = (t_next - t) / max(n_sub, 1)
+        for i in range(n_sub):
+            y = _rk4_step(fn, t + i * h, y, h)
+        t = t_next
+        ys.append(y)
+    return np.asarray(t_eval), ys
+
+
+def _solve_rk45(fn, t_span, y0, t_eval, first_step, max_step, rtol, atol):
+    t0, t1 = t_span
+    stops = list(t_eval) if t_eval is not None else []
+    ts, ys = [], []
+    if t_eval is None or np.isclose(stops[0], t0):
+        ts, ys = [t0], [y0]
+        stops = stops[1:]
+    t, y, k1 = t0, y0, fn(t0, y0)
+    dt = first_step or 1e-2 * (t1 - t0)
+    while t < t1 and not np.isclose(t, t1):
+        h = min(dt, max_step, t1 - t, *([stops[0] - t] if stops else []))
+        y_new, err, k_new = _rk45_step(fn, t, y, h, k1)
+        scale = atol + rtol * np.maximum(np.abs(y), np.abs(y_new))
+        # error norm shared across members so that every member keeps the same time grid
+        err_norm = np.sqrt(np.mean((err / scale)**2, axis=-1)).max()
+        if err_norm > 1:
+            dt = h * max(0.2, 0.9 * err_norm**-0.2)
+            continue
+        t, y, k1 = t + h, y_new, k_new
+        on_stop = bool(stops) and np.isclose(t, stops[0])
+        if on_stop:
+            t = stops.pop(0)
+        if on_stop or t_eval is None:
+            ts.append(t)
+            ys.append(y)
+        factor = 10. if err_norm == 0 else min(10., 0.9 * err_norm**-0.2)
+        dt = max(dt, h * factor) if h < dt else h * factor
+    return np.asarray(ts), ys
+
+
+def solve_ivp_batch(fn, t_span, y0, method='RK45', t_eval=None, first_step=None,
+                    max_step=np.inf, rtol=1e-3, atol=1e-6, **kwargs):
+    """
+    Integrate an ensemble of initial conditions at once.
+
+    Drop-in counterpart of `scipy.integrate.solve_ivp` for `(n_members, 3)` states:
+    every RHS evaluation of `fn` advances all the members in a single NumPy call.
+    `fn` follows the `solve_ivp` convention (components along the first axis) so that
+    `dyn_lorenz63` can be used as is.
+
+    Args:
+        fn (callable): Right-hand side `fn(t, x)` with `x` of shape (3, n_members).
+        t_span (tuple): Integration interval (t0, t1).
+        y0 (array-like): Initial states of shape (n_members, 3).
+        method (str): 'RK4' (fixed step `first_step`) or 'RK45' (adaptive Dormand-Prince).
+        t_eval (array-like, optional): Times at which to store the solution.
+        first_step (float, optional): Step size for RK4, initial step size for RK45.
+        max_step (float): Maximum step size for RK45.
+        rtol, atol (float): Tolerances for RK45, the error norm is taken as the max over members.
+
+    Returns:
+        BatchSolution: times `t` and states `y` of shape (n_members, 3, n_times).
+    """
+    y0 = np.atleast_2d(np.asarray(y0, dtype=np.float64))
+    batch_fn = lambda t, y: fn(t, y.T).T
+    t_span = tuple(float(t) for t in t_span)
+    if method.upper() == 'RK4':
+        if first_step is None:
+            raise ValueError("method 'RK4' requires a fixed step size 'first_step'")
+        t, ys = _solve_rk4(batch_fn, t_span, y0, t_eval, first_step)
+    elif method.upper() == 'RK45':
+        t, ys = _solve_rk45(batch_fn, t_span, y0, t_eval, first_step, max_step, rtol, atol)
+    else:
+        raise ValueError(f"Unsupported method {method!r} for batch integration, use 'RK4' or 'RK45'")
+    return BatchSolution(t=t, y=np.stack(ys, axis=-1))
+
+
+def _check_bank_args(y0, warmup_kw):
+    if y0 is not None or warmup_kw is not None:
+        raise ValueError("initial states are drawn from the attractor bank, y0 and warmup_kw must not be given")
+
+
+def ensemble_trajectory_da(fn, y0, solver_kw, warmup_kw=None, bank=None, seed=None, n_members=None):
+    """
+    Batched version of `trajectory_da`, `y0` has shape (n_members, 3).
+
+    With an attractor `bank`, the initial states of `n_members` members are drawn from the
+    bank with `seed` instead: `y0` must then be None and `warmup_kw` is not allowed.
+    """
+    if (bank is None) != (n_members is None):
+        raise ValueError("n_members is required with an attractor bank, and only then")
+    if bank is not None:
+        _check_bank_args(y0, warmup_kw)
+        y0 = sample_attractor_states(bank, n_members, seed=seed)
+    if warmup_kw is not None:
+        warmup = solve_ivp_batch(fn, y0=y0, **{**solver_kw, **warmup_kw})
+        y0 = warmup.y[..., -1]
+    traj = solve_ivp_batch(fn, y0=y0, **solver_kw)
+    return xr.DataArray(
+        traj.y, dims=('member', 'component', 'time'),
+        coords={'member': np.arange(traj.y.shape[0]), 'component': ['x', 'y', 'z'], 'time': traj.t}
+    )
+
+
+def attractor_bank(fn, n_states, solver_kw, warmup_kw, y0=(8., 0., 30.), y0_sigma=1., seed=0, path=None):
+    """
+    Bank of states on the attractor of `fn`, to draw initial states from instead of spinning
+    up every trajectory.
+
+    `n_states` perturbations of `y0` are spun up together in one `solve_ivp_batch` integration
+    with `{**solver_kw, **warmup_kw}` (only the final states are kept), the chaotic dynamics
+    decorrelating them.
+
+    Args:
+        path (str, optional): `.npy` file where the (n_states, 3) bank is saved, to be reloaded
+            with `load_attractor_bank`.
+
+    Returns:
+        np.ndarray: (n_states, 3) attractor states.
+    """
+    y0 = np.asarray(y0, dtype=np.float64) + y0_sigma * np.random.default_rng(seed).standard_normal((n_states, 3))
+    kw = {**solver_kw, **warmup_kw}
+    states = solve_ivp_batch(fn, y0=y0, **{**kw, 't_eval': [kw['t_span'][-1]]}).y[..., -1]
+    if path is not None:
+        np.save(path, states)
+    return states
+
+
+def load_attractor_bank(path):
+    """ Memory-mapped attractor bank saved by `attractor_bank`. """
+    return np.load(path, mmap_mode='r')
+
+
+def sample_attractor_states(bank, n=None, seed=None):
+    """ One state (3,), or `n` distinct states (n, 3), drawn from `bank` with `seed`. """
+    idx = np.random.default_rng(seed).choice(len(bank), size=n, replace=False)
+    return np.array(bank[idx], dtype=np.float64)
+
+
 def only_first_obs(da):
     new_da = xr.full_like(da, np.nan)
     new_da.loc['x']=da.loc['x']
@@ -37,8 +279,116 @@ def subsample(da, sample_step=20):
     new_da.loc[:, ::sample_step]=da.loc[:, ::sample_step]
     return new_da
 
-def add_noise(da, sigma=2**.5):
-    return da  + np.random.randn(*da.shape) * sigma
+def add_noise(da, sigma=2**.5, rng=None):
+    noise = np.random.randn(*da.shape) if rng is None else rng.standard_normal(da.shape)
+    return da  + noise * sigma
+
+
+def mask_components(mask, rng, components=('x',)):
+    """ Observation mask operator: keep only `components`. """
+    mask &= mask['component'].isin(list(components))
+
+
+def mask_subsample(mask, rng, sample_step=20, dim='time'):
+    """ Observation mask operator: keep one step every `sample_step` along `dim`. """
+    mask &= xr.DataArray(np.arange(mask.sizes[dim]) % sample_step == 0, dims=(dim,))
+
+
+def mask_random(mask, rng, rate=0.05, dims=('time',)):
+    """ Observation mask operator: keep random irregular samples with probability `rate`, drawn over `dims`. """
+    dims = mask.dims if dims is None else tuple(dims)
+    mask &= xr.DataArray(rng.random([mask.sizes[d] for d in dims]) < rate, dims=dims)
+
+
+def observe(da, mask_fns=(), sigma=None, rng=None):
+    """
+    Apply a chain of observation mask operators and additive noise in one pass.
+
+    Each `mask_fn(mask, rng)` updates in place a boolean mask shaped like `da`; the noise is
+    only drawn at the observed points and the output is the single full-size allocation.
+    Equivalent to chaining `only_first_obs`, `subsample` and `add_noise` without their
+    intermediate NaN and noise copies.
+
+    Args:
+        da (xr.DataArray): Trajectory to observe.
+        mask_fns (sequence): Mask operators such as `mask_components`, `mask_subsample`, `mask_random`.
+        sigma (float, optional): Standard deviation of the observation noise.
+        rng (np.random.Generator or int, optional): Random generator or seed for noise and random masks,
+            seeded from the global NumPy random state when None (as `add_noise`). A seed gives the
+            same draw on every call.
+
+    Returns:
+        xr.DataArray: Observations with NaN where not observed.
+    """
+    mask, values = _observed_values(da, mask_fns, sigma, rng)
+    obs = np.full(da.shape, np.nan)
+    obs[mask] = values
+    return da.copy(deep=False, data=obs)
+
+
+def _observed_values(da, mask_fns, sigma, rng):
+    # without rng, draw from the global NumPy random state so that `np.random.seed` applies
+    rng = np.random.default_rng(np.random.randint(2**32) if rng is None else rng)
+    mask = xr.ones_like(da, dtype=bool)
+    for mask_fn in mask_fns:
+        mask_fn(mask, rng)
+    values = da.values[mask.values]
+    if sigma:
+        values += sigma * rng.standard_normal(values.shape)
+    return mask.values, values
+
+
+def observe_sparse(da, mask_fns=(), sigma=None, rng=None):
+    """ `observe` returning a `SparseObs` instead of a NaN-filled full-size array (same draws for the same `rng`). """
+    mask, values = _observed_values(da, mask_fns, sigma, rng)
+    return SparseObs(np.stack(np.nonzero(mask)).astype(np.int32), values, da.shape)
+
+
+def observation_fn(*mask_fns, sigma=None, rng=None, sparse=False):
+    """
+    Compose mask operators into an `obs_fn` for `training_da`, e.g. `observation_fn(mask_components, mask_subsample)`.
+    With `sparse=True` the observations are `SparseObs`, for `sparse_training_da`.
+
+    A seed `rng` is turned into a generator once, shared by the successive calls of the `obs_fn`
+    (e.g. the chunks of `iter_training_da`), which draw new noise and masks. Worker processes
+    (`generate_ensemble`, DataLoader workers) each unpickle a copy of its state and repeat the
+    same draws: leave `rng` None there, they seed the global random state per member or batch.
+    """
+    rng = None if rng is None else np.random.default_rng(rng)
+    return ft.partial(observe_sparse if sparse else observe, mask_fns=mask_fns, sigma=sigma, rng=rng)
+
+
+def to_sparse(npa):
+    """ `SparseObs` of the finite values of an array (or DataArray) with NaN for missing values. """
+    npa = np.asarray(npa)
+    index = np.nonzero(np.isfinite(npa))
+    return SparseObs(np.stack(index).astype(np.int32), npa[index], npa.shape)
+
+
+def densify(obs):
+    """ Dense array (torch tensor if `obs.values` is one) of `obs` with NaN for missing values. """
+    if isinstance(obs.values, torch.Tensor):
+        out = torch.full(tuple(obs.shape), float('nan'), dtype=obs.values.dtype, device=obs.values.device)
+        out[tuple(obs.index.long())] = obs.values
+        return out
+    out = np.full(obs.shape, np.nan, dtype=obs.values.dtype)
+    out[tuple(obs.index)] = obs.values
+    return out
+
+
+def slice_sparse(obs, start, stop):
+    """ Observations of `obs` in [start, stop) along the last axis, as a `SparseObs` of that window. """
+    keep = (obs.index[-1] >= start) & (obs.index[-1] < stop)
+    index = obs.index[:, keep].copy()
+    index[-1] -= start
+    return SparseObs(index, obs.values[keep], (*obs.shape[:-1], stop - start))
+
+
+def densify_batch(batch):
+    """ Replace the `SparseObs` fields of a batch namedtuple by dense tensors, at the model boundary. """
+    return batch._replace(**{
+        field: densify(value) for field, value in zip(batch._fields, batch) if isinstance(value, SparseObs)
+    })
 
 def interpolate_grid_data(npa):
     data_points = np.nonzero(np.isfinite(npa))
@@ -58,35 +408,617 @@ def interpolate_grid_data(npa):
     new_npa[tgt_points] = tgt_values
     return new_npa
 
-def training_da(traj_da, obs_fn):
+_TIME_INTERPOLATORS = {
+    'linear': lambda x, y: scipy.interpolate.make_interp_spline(x, y, k=1, axis=-1),
+    'cubic': lambda x, y: scipy.interpolate.make_interp_spline(x, y, k=min(3, len(x) - 1), axis=-1),
+    'akima': lambda x, y: scipy.interpolate.Akima1DInterpolator(x, y, axis=-1),
+}
+
+
+def interpolate_time_series(npa, method='cubic'):
+    """
+    Interpolate the missing values of time series along the last axis.
+
+    All leading axes (members, components) are processed together: rows sharing the same
+    observation pattern are fitted with a single vectorized interpolator. As with
+    `interpolate_grid_data`, positions are used as abscissa and values outside of the
+    first/last observation are left to NaN, so that 'cubic' reproduces its output.
+
+    Args:
+        npa (np.ndarray): Array with NaN for missing values, time on the last axis.
+        method (str): One of 'linear', 'cubic' (not-a-knot spline) or 'akima'.
+
+    Returns:
+        np.ndarray: Interpolated array with the same shape as `npa`.
+    """
+    interpolator = _TIME_INTERPOLATORS[method]
+    rows = np.asarray(npa).reshape(-1, np.shape(npa)[-1])
+    mask = np.isfinite(rows)
+    new_rows = np.where(mask, rows, np.nan)
+    groups = collections.defaultdict(list)
+    for i, packed in enumerate(np.packbits(mask, axis=-1)):
+        groups[packed.tobytes()].append(i)
+    for sel in groups.values():
+        obs_t = np.flatnonzero(mask[sel[0]])
+        if len(obs_t) < 2:
+            continue
+        tgt_t = np.arange(obs_t[0], obs_t[-1] + 1)
+        new_rows[np.ix_(sel, tgt_t)] = interpolator(obs_t, rows[sel][:, obs_t])(tgt_t)
+    return new_rows.reshape(np.shape(npa))
+
+
+def interpolate_sparse(obs, method='cubic'):
+    """
+    `interpolate_time_series` of sparse observations, without their NaN-filled dense array.
+
+    Rows sharing the same observation times are fitted with a single vectorized interpolator.
+
+    `obs` has time on the last axis and at least one leading axis; its index has to be in
+    C order (as built by `to_sparse` and `observe_sparse`).
+    """
+    interpolator = _TIME_INTERPOLATORS[method]
+    out = np.full(obs.shape, np.nan)
+    rows = out.reshape(-1, obs.shape[-1])
+    row_idx = np.ravel_multi_index(tuple(obs.index[:-1]), obs.shape[:-1])
+    obs_t = obs.index[-1]
+    rows[row_idx, obs_t] = obs.values
+    # the rows are contiguous in the C ordered index, bounded with one binary search
+    bounds = np.searchsorted(row_idx, np.arange(rows.shape[0] + 1))
+    groups = collections.defaultdict(list)
+    for row in np.flatnonzero(np.diff(bounds) >= 2):
+        groups[obs_t[bounds[row]:bounds[row + 1]].tobytes()].append(row)
+    for sel in groups.values():
+        times = obs_t[bounds[sel[0]]:bounds[sel[0] + 1]]
+        values = obs.values[bounds[sel][:, None] + np.arange(len(times))]
+        tgt_t = np.arange(times[0], times[-1] + 1)
+        rows[np.ix_(sel, tgt_t)] = interpolator(times, values)(tgt_t)
+    return out
+
+
+def _init_fn(interp_method):
+    if interp_method == 'griddata':
+        return lambda da: (
+            da.to_dataset(dim='component')
+            .map(lambda da: xr.apply_ufunc(interpolate_grid_data, da))
+            .to_array(dim='component')
+        )
+    return lambda da: xr.apply_ufunc(
+        interpolate_time_series, da.transpose(..., 'time'), kwargs=dict(method=interp_method)
+    )
+
+
+def training_da(traj_da, obs_fn, interp_method='cubic'):
+    """
+    Stack the observations, target and interpolated first guess of a trajectory.
+
+    `interp_method` is passed to `interpolate_time_series`, 'griddata' selects the
+    former per-component `interpolate_grid_data` path.
+    """
     return xr.Dataset(
         dict(
             input=traj_da.pipe(obs_fn),
             tgt=traj_da,
     )).assign(
-        init=lambda ds: (
-                ds.input
-                .to_dataset(dim='component')
-                .map(lambda da: xr.apply_ufunc(interpolate_grid_data, da))
-                .to_array(dim='component')
-        )
+        init=lambda ds: ds.input.pipe(_init_fn(interp_method))
     ).to_array().sortby('variable')
 
 
+def sparse_training_da(traj_da, obs_fn, interp_method='cubic'):
+    """
+    `training_da` keeping the observations sparse.
+
+    Args:
+        traj_da (xr.DataArray): (component, time) trajectory.
+        obs_fn (callable): Observation function returning a `SparseObs` (e.g.
+            `observation_fn(..., sparse=True)`) or a NaN-filled array.
+        interp_method (str): Method of `interpolate_sparse`.
+
+    Returns:
+        tuple: The (variable, component, time) array of the 'init' and 'tgt' variables, and
+        the `SparseObs` of the input over (component, time).
+    """
+    obs = traj_da.pipe(obs_fn)
+    if not isinstance(obs, SparseObs):
+        obs = to_sparse(obs)
+    init = traj_da.copy(data=interpolate_sparse(obs, method=interp_method))
+    return xr.concat([init, traj_da], dim='variable').assign_coords(variable=['init', 'tgt']), obs
+
+
+def iter_training_da(traj_da, obs_fn, chunk_size, overlap=None, interp_method='cubic'):
+    """
+    Generate `training_da` chunk by chunk along the time dimension.
+
+    Only the current chunk and its two neighbours are held in memory, which bounds the
+    peak memory by `chunk_size` instead of the trajectory length (`traj_da` can be lazily
+    loaded, e.g. opened from netCDF). `obs_fn` is applied once per chunk; the first guess
+    of each chunk is interpolated from its observations extended with `overlap` time steps
+    of the neighbouring chunks' observations, so that chunks join smoothly.
+
+    Position-based observation functions such as `subsample` see each chunk on its own:
+    use a `chunk_size` multiple of their step to keep the global sampling pattern.
+
+    Args:
+        traj_da (xr.DataArray): Trajectory with a 'time' dimension.
+        obs_fn (callable): Observation function, as in `training_da`.
+        chunk_size (int): Number of time steps per chunk.
+        overlap (int, optional): Time steps borrowed from each neighbour for the
+            interpolation, defaults to (and is capped at) `chunk_size`.
+        interp_method (str): Interpolation method, as in `training_da`.
+
+    Yields:
+        xr.DataArray: (variable, ..., time) chunks of the stacked training array.
+    """
+    overlap = chunk_size if overlap is None else min(overlap, chunk_size)
+    init_fn = _init_fn(interp_method)
+    chunks = (
+        traj_da.isel(time=slice(start, start + chunk_size))
+        for start in range(0, traj_da.sizes['time'], chunk_size)
+    )
+    prev_inp, tgt, inp = None, None, None
+    for next_tgt in itertools.chain(chunks, [None]):
+        next_inp = next_tgt.pipe(obs_fn) if next_tgt is not None else None
+        if tgt is not None:
+            left = prev_inp.isel(time=slice(-overlap, None)) if prev_inp is not None and overlap else None
+            right = next_inp.isel(time=slice(None, overlap)) if next_inp is not None and overlap else None
+            ext_inp = xr.concat([da for da in (left, inp, right) if da is not None], dim='time')
+            offset = left.sizes['time'] if left is not None else 0
+            yield xr.Dataset(dict(
+                input=inp,
+                tgt=tgt,
+                init=ext_inp.pipe(init_fn).isel(time=slice(offset, offset + tgt.sizes['time'])),
+            )).to_array().sortby('variable')
+        prev_inp, tgt, inp = inp, next_tgt, next_inp
+
+
+@contextlib.contextmanager
+def global_seed(seed):
+    """
+    Seed the global NumPy random state (drawn from by `add_noise`) and restore it on exit,
+    fresh entropy when `seed` is None.
+    """
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def _generate_member(path, idx, y0, seed_state, fn, solver_kw, obs_fn, warmup_kw, interp_method):
+    with global_seed(seed_state):
+        da = training_da(trajectory_da(fn, y0, solver_kw, warmup_kw), obs_fn, interp_method=interp_method)
+    out = np.load(path, mmap_mode='r+')
+    out[idx] = da.values
+    out.flush()
+
+
+def generate_ensemble(n_members, fn, y0, solver_kw, obs_fn, warmup_kw=None, y0_sigma=1., seed=0,
+                      interp_method='cubic', workers=None, path=None, dtype=np.float32):
+    """
+    Generate the `training_da` of `n_members` trajectories over a process pool.
+
+    Every member is written by its worker into a shared `.npy` memory-mapped array. Member
+    `i` uses its own seed drawn from `np.random.SeedSequence(seed)` for the initial state
+    perturbation and the global random state of `add_noise`, so results do not depend on
+    the number of workers. `fn` and `obs_fn` have to be picklable when `workers != 1`
+    (functions, `functools.partial`, `toolz` compositions but not lambdas).
+
+    Args:
+        n_members (int): Number of trajectories.
+        fn, solver_kw, warmup_kw: Arguments of `trajectory_da`.
+        y0 (array-like): Initial state (3,) perturbed by `y0_sigma` per member, or (n_members, 3) states,
+            e.g. `sample_attractor_states(bank, n_members)` with `warmup_kw=None`.
+        obs_fn, interp_method: Arguments of `training_da`.
+        seed (int): Root seed of the ensemble.
+        workers (int, optional): Number of processes, defaults to the number of CPUs; 1 runs in-process.
+        path (str, optional): Output `.npy` file, left to the caller. Defaults to a temporary
+            file owned by the returned array: it is removed once the array (and every view of
+            it) is garbage collected, or at interpreter exit.
+        dtype: Dtype of the stored array.
+
+    Returns:
+        xr.DataArray: (member, variable, component, time) array memory-mapped from `path`.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(n_members)
+    y0 = np.asarray(y0, dtype=np.float64)
+    if y0.ndim == 1:
+        y0 = y0 + y0_sigma * np.stack([np.random.default_rng(s).standard_normal(3) for s in seeds])
+    tmp_file = path is None
+    if tmp_file:
+        fd, path = tempfile.mkstemp(suffix='.npy', prefix='lorenz63_ensemble_')
+        os.close(fd)
+    gen_kw = dict(fn=fn, solver_kw=solver_kw, obs_fn=obs_fn, warmup_kw=warmup_kw, interp_method=interp_method)
+
+    try:
+        # the first member is generated in-process to get the shape and coords of the output
+        with global_seed(seeds[0].generate_state(4)):
+            first = training_da(trajectory_da(fn, y0[0], solver_kw, warmup_kw), obs_fn, interp_method=interp_method)
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_members, *first.shape))
+        out[0] = first.values
+        out.flush()
+        del out
+
+        tasks = [(path, i, y0[i], seeds[i].generate_state(4)) for i in range(1, n_members)]
+        if workers == 1:
+            for task in tasks:
+                _generate_member(*task, **gen_kw)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_generate_member, *task, **gen_kw) for task in tasks]
+                for future in futures:
+                    future.result()
+    except BaseException:
+        if tmp_file:
+            os.remove(path)
+        raise
+    data = np.load(path, mmap_mode='r')
+    if tmp_file:
+        weakref.finalize(data, os.remove, path)
+    return xr.DataArray(
+        data, dims=('member', *first.dims),
+        coords={'member': np.arange(n_members), **first.coords},
+    )
+
+
+class WindowXrDataset(src.data.XrDataset):
+    """
+    `XrDataset` indexing strided window views of the data instead of xarray selections.
+
+    The windows are built once with `sliding_window_view` over the patch dims, so
+    `__getitem__` is an O(1) view lookup and the only allocation is the final float32
+    conversion. Memory-mapped inputs stay memory-mapped. The patch dims have to be the
+    trailing dims of the data array, in order.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        n_dims = len(self.patch_dims)
+        if list(self.da.dims[len(self.da.dims) - n_dims:]) != list(self.patch_dims):
+            raise src.data.DangerousDimOrdering(
+                f"patch dims {list(self.patch_dims)} should be the trailing dims of {self.da.dims}"
+            )
+        windows = np.lib.stride_tricks.sliding_window_view(
+            np.asarray(self.da.data), list(self.patch_dims.values()), axis=tuple(range(-n_dims, 0))
+        )
+        self.windows = windows[(
+            ...,
+            *[slice(None, None, self.strides.get(dim, 1)) for dim in self.patch_dims],
+            *[slice(None)] * n_dims,
+        )]
+
+    def __getitem__(self, item):
+        if self.return_coords:
+            return super().__getitem__(item)
+        n_dims = len(self.patch_dims)
+        idx = np.unravel_index(item, tuple(self.ds_size.values()))
+        item = self.windows[(..., *idx, *[slice(None)] * n_dims)].astype(np.float32)
+        if self.postpro_fn is not None:
+            return self.postpro_fn(item)
+        return item
+
+
+class TensorXrDataset(WindowXrDataset):
+    """
+    `WindowXrDataset` backed by a single contiguous, normalized float32 torch tensor.
+
+    The data array is converted and normalized once; items are `unfold` views of that
+    tensor. `__getitem__` also accepts a sequence of indices and then gathers the whole
+    batch in one indexing op, to be used with `batch_size=None` and a `BatchSampler`.
+
+    Args:
+        norm_stats (tuple): (mean, std) applied once at conversion.
+        share_memory (bool): Move the tensor to shared memory so that DataLoader workers
+            do not copy it.
+        pin_memory (bool): Pin the tensor (when CUDA is available) for asynchronous transfers.
+    """
+    def __init__(self, *args, norm_stats=(0., 1.), share_memory=False, pin_memory=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        mean, std = norm_stats
+        self.tensor = (torch.from_numpy(np.asarray(self.da.data, dtype=np.float32)) - mean) / std
+        if share_memory:
+            self.tensor.share_memory_()
+        if pin_memory and torch.cuda.is_available():
+            self.tensor = self.tensor.pin_memory()
+        n_lead = self.tensor.ndim - len(self.patch_dims)
+        windows = self.tensor
+        for axis, dim in enumerate(self.patch_dims, start=n_lead):
+            windows = windows.unfold(axis, self.patch_dims[dim], self.strides.get(dim, 1))
+        self.windows = windows
+
+    def __getitem__(self, item):
+        if self.return_coords:
+            return super().__getitem__(item)
+        n_dims = len(self.patch_dims)
+        idx = [torch.as_tensor(i) for i in np.unravel_index(item, tuple(self.ds_size.values()))]
+        batch = self.windows[(..., *idx, *[slice(None)] * n_dims)]
+        if np.ndim(item) > 0:
+            # advanced indexing puts the batch dim after the leading dims
+            batch = batch.movedim(batch.ndim - n_dims - 1, 0)
+        if self.postpro_fn is not None:
+            return self.postpro_fn(batch)
+        return batch
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """
+    Dataset of `IndexedTrainingItem`s: the `TrainingItemWithInit` items of `ds` with their
+    index, e.g. to key a `warm_start.WarmStartStore`. Sequences of indices (batch indexing
+    of `TensorXrDataset`) are supported.
+    """
+    def __init__(self, ds):
+        self.ds = ds
+
+    def __len__(self):
+        return len(self.ds)
+
+    def __getitem__(self, item):
+        return IndexedTrainingItem(*self.ds[item], torch.as_tensor(item))
+
+    def reconstruct(self, *args, **kwargs):
+        return self.ds.reconstruct(*args, **kwargs)
+
+
+class SparseObsDataset(WindowXrDataset):
+    """
+    `WindowXrDataset` of `TrainingItemWithInit`s whose `input` is a `SparseObs` window.
+
+    The dense data array only holds the 'init' and 'tgt' variables, the observations are
+    kept sparse and sliced per item with a binary search along time. Items are passed to
+    `postpro_fn` as `TrainingItemWithInit`s and batched with `collate_sparse`.
+
+    Args:
+        obs (SparseObs): Observations over the (component, time) trailing dims of the data array.
+    """
+    def __init__(self, *args, obs, **kwargs):
+        super().__init__(*args, **kwargs)
+        if tuple(obs.shape) != self.da.shape[-len(obs.shape):]:
+            raise ValueError(f"observations of shape {tuple(obs.shape)} do not match the data array {self.da.shape}")
+        order = np.argsort(obs.index[-1], kind='stable')
+        self.obs = SparseObs(obs.index[:, order], obs.values[order], tuple(obs.shape))
+        obs_dims = self.da.dims[-len(obs.shape):]
+        self._obs_sizes = np.array([self.patch_dims.get(dim, self.da.sizes[dim]) for dim in obs_dims])
+        self._obs_dims = obs_dims
+
+    def __getitem__(self, item):
+        if self.return_coords:
+            return super().__getitem__(item)
+        n_dims = len(self.patch_dims)
+        idx = np.unravel_index(item, tuple(self.ds_size.values()))
+        init, tgt = self.windows[(..., *idx, *[slice(None)] * n_dims)].astype(np.float32)
+        starts = {dim: i * self.strides.get(dim, 1) for dim, i in zip(self.ds_size, idx)}
+        start = np.array([starts.get(dim, 0) for dim in self._obs_dims])
+        lo, hi = np.searchsorted(self.obs.index[-1], [start[-1], start[-1] + self._obs_sizes[-1]])
+        index = self.obs.index[:, lo:hi] - start[:, None]
+        keep = ((index >= 0) & (index < self._obs_sizes[:, None])).all(0)
+        item = TrainingItemWithInit(
+            init=torch.from_numpy(init),
+            input=SparseObs(
+                torch.from_numpy(index[:, keep].astype(np.int64)),
+                torch.from_numpy(self.obs.values[lo:hi][keep].astype(np.float32)),
+                tuple(self._obs_sizes.tolist()),
+            ),
+            tgt=torch.from_numpy(tgt),
+        )
+        if self.postpro_fn is not None:
+            return self.postpro_fn(item)
+        return item
+
+
+class OnTheFlyDataset(torch.utils.data.IterableDataset):
+    """
+    Infinite stream of normalized `TrainingItemWithInit` batches of freshly integrated windows.
+
+    Each batch integrates `batch_size` trajectories from states drawn from an attractor `bank`
+    in one `ensemble_trajectory_da` call, observes them with `obs_fn` and interpolates the
+    first guess as `training_da`. The drawn states are perturbed by `y0_sigma` and spun up over
+    `warmup_time` before the window, so that the target windows do not repeat the finite bank.
+    `margin` time steps are integrated before and after each window and dropped, so that the
+    first guess is interpolated from neighbouring observations as in the inner windows of a
+    fixed trajectory. Every DataLoader worker draws its own states;
+    the DataLoader `prefetch_factor` bounds the batches queued ahead of the training loop.
+
+    Args:
+        fn, solver_kw: Arguments of `ensemble_trajectory_da`, `solver_kw` spanning one window
+            (margins included).
+        obs_fn (callable): Observation function applied to the (member, component, time)
+            trajectories, e.g. `observation_fn(...)` without `rng`, see `observation_fn`.
+        bank (np.ndarray): Attractor states, see `attractor_bank`.
+        batch_size (int): Number of windows per batch.
+        y0_sigma (float): Standard deviation of the perturbation of the drawn states.
+        warmup_time (float): Duration of the spin-up of the perturbed states back onto the attractor.
+        norm_stats (tuple): (mean, std) normalization.
+        margin (int): Time steps dropped at both ends of the windows.
+        n_batches (int, optional): Batches per iteration (epoch), shared by the workers;
+            infinite when None.
+        seed (int, optional): Seed of the states and observation noise. Non-persistent
+            workers replay the same stream at each epoch, unset for fresh entropy.
+        interp_method (str): Interpolation method, as in `training_da`.
+    """
+    def __init__(self, fn, solver_kw, obs_fn, bank, batch_size, norm_stats=(0., 1.), margin=0, n_batches=None,
+                 seed=None, interp_method='cubic', y0_sigma=1., warmup_time=1.):
+        super().__init__()
+        self.fn = fn
+        self.solver_kw = solver_kw
+        self.obs_fn = obs_fn
+        self.bank = bank
+        self.batch_size = batch_size
+        self.y0_sigma = y0_sigma
+        self.warmup_time = warmup_time
+        self.norm_stats = norm_stats
+        self.margin = margin
+        self.n_batches = n_batches
+        self.seed = seed
+        self.interp_method = interp_method
+        self._n_iter = 0
+
+    def generate_batch(self, rng):
+        """ One normalized batch of windows starting from perturbed states of the bank drawn with `rng`. """
+        y0 = sample_attractor_states(self.bank, self.batch_size, seed=rng)
+        y0 += self.y0_sigma * rng.standard_normal(y0.shape)
+        warmup_kw = dict(t_span=[0., self.warmup_time], t_eval=[self.warmup_time]) if self.warmup_time else None
+        traj_da = ensemble_trajectory_da(self.fn, y0, self.solver_kw, warmup_kw)
+        with global_seed(rng.integers(2**32)):
+            da = training_da(traj_da, self.obs_fn, interp_method=self.interp_method)
+        da = da.isel(time=slice(self.margin, da.sizes['time'] - self.margin)).transpose('member', 'variable', ...)
+        mean, std = self.norm_stats
+        batch = (torch.from_numpy(da.values.astype(np.float32)) - mean) / std
+        return TrainingItemWithInit._make(batch.unbind(1))
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        entropy = np.random.SeedSequence().entropy if self.seed is None else self.seed
+        rng = np.random.default_rng([entropy, worker_id, self._n_iter])
+        self._n_iter += 1
+        n_batches = None if self.n_batches is None else len(range(worker_id, self.n_batches, n_workers))
+        for _ in itertools.count() if n_batches is None else range(n_batches):
+            yield self.generate_batch(rng)
+
+
+def unbind_variables(batch):
+    """ Split a (..., variable, component, time) tensor into a `TrainingItemWithInit`. """
+    return TrainingItemWithInit._make(batch.unbind(-3))
+
+
+def normalize_collate(items, mean, std):
+    """ Collate raw (variable, component, time) items and normalize the whole batch in one op. """
+    batch = (torch.from_numpy(np.stack(items)) - mean) / std
+    return TrainingItemWithInit._make(batch.unbind(1))
+
+
+def collate_sparse(items):
+    """
+    Collate items (namedtuples) with `SparseObs` fields: their index gets a leading batch
+    row and the observations of the batch are concatenated, the other fields are stacked.
+    """
+    fields = []
+    for values in zip(*items):
+        if isinstance(values[0], SparseObs):
+            fields.append(SparseObs(
+                torch.cat([
+                    torch.cat([torch.full_like(obs.index[:1], i), obs.index]) for i, obs in enumerate(values)
+                ], dim=1),
+                torch.cat([obs.values for obs in values]),
+                (len(values), *values[0].shape),
+            ))
+        else:
+            fields.append(torch.utils.data.default_collate(values))
+    return type(items[0])(*fields)
+
+
 class LorenzDataModule(src.data.BaseDataModule):
+    """
+    Data module yielding `TrainingItemWithInit` batches.
+
+    With `collate_norm=True` the items are left raw by the datasets and the normalization
+    is applied once per batch by the DataLoader's `collate_fn` (not compatible with `aug_kw`).
+    With `window_index=True` the datasets are `WindowXrDataset`s.
+    With `tensor_backend=True` the datasets are normalized `TensorXrDataset`s and the
+    dataloaders draw whole batches of indices at once (not compatible with `aug_kw`).
+    With `with_index=True` the training batches are `IndexedTrainingItem`s carrying their
+    dataset indices (not compatible with `collate_norm`).
+    With sparse observations `obs` (over the (component, time) dims of `input_da`, which then
+    only holds the 'init' and 'tgt' variables, see `sparse_training_da`) the datasets are
+    `SparseObsDataset`s and the batch inputs are `SparseObs`, densified by the model with
+    `densify_batch` (not compatible with `collate_norm`, `tensor_backend` and `aug_kw`).
+    With `on_the_fly_kw` (keyword arguments of `OnTheFlyDataset` but `batch_size` and
+    `norm_stats`) the training batches are generated on the fly, `input_da` only provides the
+    validation and test data and the normalization (not compatible with `collate_norm`,
+    `with_index` and `aug_kw`).
+    """
+    def __init__(self, *args, collate_norm=False, window_index=False, tensor_backend=False, with_index=False,
+                 obs=None, on_the_fly_kw=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if collate_norm and with_index:
+            raise ValueError("with_index is not compatible with collate_norm")
+        if collate_norm and self.aug_kw:
+            raise ValueError("aug_kw is not compatible with collate_norm")
+        if tensor_backend and self.aug_kw:
+            raise ValueError("aug_kw is not compatible with tensor_backend")
+        if obs is not None and (collate_norm or tensor_backend or self.aug_kw):
+            raise ValueError("sparse observations are not compatible with collate_norm, tensor_backend and aug_kw")
+        if on_the_fly_kw is not None and (collate_norm or with_index or self.aug_kw):
+            raise ValueError("on_the_fly_kw is not compatible with collate_norm, with_index and aug_kw")
+        self.collate_norm = collate_norm
+        self.window_index = window_index
+        self.tensor_backend = tensor_backend
+        self.with_index = with_index
+        self.obs = obs
+        self.on_the_fly_kw = on_the_fly_kw
+
     def post_fn(self):
+        if self.collate_norm:
+            return None
+        mean, std = self.norm_stats()
+        if self.obs is not None:
+            return lambda item: item._replace(
+                init=(item.init - mean) / std, tgt=(item.tgt - mean) / std,
+                input=item.input._replace(values=(item.input.values - mean) / std),
+            )
+        return lambda item: TrainingItemWithInit._make((item - mean) / std)
+
+    def _domain_obs(self, da):
+        start = self.input_da.get_index('time').get_loc(da['time'].values[0])
+        return slice_sparse(self.obs, start, start + da.sizes['time'])
+
+    def setup(self, stage='test'):
+        if self.tensor_backend:
+            ds_fn = ft.partial(
+                TensorXrDataset, **self.xrds_kw, postpro_fn=unbind_variables, norm_stats=self.norm_stats(),
+                share_memory=self.dl_kw.get('num_workers', 0) > 0, pin_memory=self.dl_kw.get('pin_memory', False),
+            )
+        elif self.obs is not None:
+            post_fn = self.post_fn()
+            ds_fn = lambda da: SparseObsDataset(da, **self.xrds_kw, obs=self._domain_obs(da), postpro_fn=post_fn)
+            self.dl_kw = {**self.dl_kw, 'collate_fn': collate_sparse}
+        elif self.window_index:
+            ds_fn = ft.partial(WindowXrDataset, **self.xrds_kw, postpro_fn=self.post_fn())
+        else:
+            ds_fn = None
+
+        if self.collate_norm and not self.tensor_backend:
+            mean, std = self.norm_stats()
+            self.dl_kw = {**self.dl_kw, 'collate_fn': ft.partial(normalize_collate, mean=mean, std=std)}
+        if ds_fn is None:
+            super().setup(stage)
+        else:
+            self.train_ds = ds_fn(self.input_da.sel(self.domains['train']))
+            if self.aug_kw:
+                self.train_ds = src.data.AugmentedDataset(self.train_ds, **self.aug_kw)
+            self.val_ds = ds_fn(self.input_da.sel(self.domains['val']))
+            self.test_ds = ds_fn(self.input_da.sel(self.domains['test']))
 
-        normalize = lambda item: (item - self.norm_stats()[0]) / self.norm_stats()[1]
-        return ft.partial(
-            ft.reduce,
-            lambda i, f: f(i),
-            [
-                TrainingItemWithInit._make,
-                lambda item: item._replace(tgt=normalize(item.tgt)),
-                lambda item: item._replace(input=normalize(item.input)),
-                lambda item: item._replace(init=normalize(item.init)),
-            ],
+        if self.with_index:
+            self.train_ds = IndexedDataset(self.train_ds)
+        if self.on_the_fly_kw is not None:
+            self.train_ds = OnTheFlyDataset(
+                **self.on_the_fly_kw, batch_size=self.dl_kw.get('batch_size', 1), norm_stats=self.norm_stats()
+            )
+
+    def _batch_dataloader(self, ds, shuffle):
+        dl_kw = {k: v for k, v in self.dl_kw.items() if k not in ['batch_size', 'drop_last', 'collate_fn']}
+        sampler = torch.utils.data.BatchSampler(
+            torch.utils.data.RandomSampler(ds) if shuffle else torch.utils.data.SequentialSampler(ds),
+            batch_size=self.dl_kw.get('batch_size', 1), drop_last=self.dl_kw.get('drop_last', False),
         )
+        return torch.utils.data.DataLoader(ds, batch_size=None, sampler=sampler, **dl_kw)
+
+    def train_dataloader(self):
+        if self.on_the_fly_kw is not None:
+            dl_kw = {k: v for k, v in self.dl_kw.items() if k not in ['batch_size', 'drop_last', 'collate_fn']}
+            return torch.utils.data.DataLoader(self.train_ds, batch_size=None, **dl_kw)
+        if self.tensor_backend:
+            return self._batch_dataloader(self.train_ds, shuffle=True)
+        return super().train_dataloader()
+
+    def val_dataloader(self):
+        if self.tensor_backend:
+            return self._batch_dataloader(self.val_ds, shuffle=False)
+        return super().val_dataloader()
+
+    def test_dataloader(self):
+        if self.tensor_backend:
+            return self._batch_dataloader(self.test_ds, shuffle=False)
+        return super().test_dataloader()
 
 if __name__ == '__main__':
     import contrib.lorenz63
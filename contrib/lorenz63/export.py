@@ -0,0 +1,156 @@
+"""
+TorchScript export of the Lorenz 4DVarNet inference graph.
+
+`export_solver` converts an (eval mode) `SolverWithInit` made of bilinear autoencoder priors
+(a single one or a `MultiPrior`), a ConvLSTM grad model and a `BaseObsCost` into a TorchScript
+module running the whole unrolled solver loop, gradients included, in the TorchScript
+interpreter. The saved artifact is loaded with `load_solver` (plain `torch.jit.load`), without
+Lightning, hydra or `src`.
+
+Usage:
+    python -m contrib.lorenz63.export CHECKPOINT OUTPUT
+"""
+
+import argparse
+from typing import List, Optional
+import torch
+import torch.nn.functional as F
+import src.models
+
+
+class ScriptableBilinAE(torch.nn.Module):
+    """ TorchScript version of `src.models.BilinAEPriorCost.forward_ae`, sharing the layers of `prior`. """
+    def __init__(self, prior):
+        super().__init__()
+        self.bilin_quad = prior.bilin_quad
+        for name in ['down', 'conv_in', 'conv_hidden', 'bilin_1', 'bilin_21', 'bilin_22', 'conv_out', 'up']:
+            setattr(self, name, getattr(prior, name))
+
+    def forward(self, x):
+        x = self.conv_in(self.down(x))
+        x = self.conv_hidden(F.relu(x))
+        if self.bilin_quad:
+            nonlin = self.bilin_21(x)**2
+        else:
+            nonlin = self.bilin_21(x) * self.bilin_22(x)
+        return self.up(self.conv_out(torch.cat([self.bilin_1(x), nonlin], dim=1)))
+
+
+class ScriptableConvLstm(torch.nn.Module):
+    """ TorchScript version of `src.models.ConvLstmGradModel` in eval mode, with explicit recurrent state. """
+    def __init__(self, grad_mod):
+        super().__init__()
+        self.dim_hidden = grad_mod.dim_hidden
+        for name in ['down', 'gates', 'conv_out', 'up']:
+            setattr(self, name, getattr(grad_mod, name))
+
+    def init_state(self, inp) -> List[torch.Tensor]:
+        zeros = self.down(inp.new_zeros([inp.shape[0], self.dim_hidden] + inp.shape[2:]))
+        return [zeros, zeros]
+
+    def forward(self, x, hidden, cell, grad_norm):
+        x = self.down(x / grad_norm)
+        gates = self.gates(torch.cat((x, hidden), 1))
+        in_gate, remember_gate, out_gate, cell_gate = gates.chunk(4, 1)
+        cell = torch.sigmoid(remember_gate) * cell + torch.sigmoid(in_gate) * torch.tanh(cell_gate)
+        hidden = torch.sigmoid(out_gate) * torch.tanh(cell)
+        return self.up(self.conv_out(hidden)), hidden, cell
+
+
+class ScriptableSolver(torch.nn.Module):
+    """
+    Unrolled `SolverWithInit` inference: `forward(input, init)` with (batch, component, time)
+    normalized observations (NaN when missing) and initial state, as in `TrainingItemWithInit`.
+    Has to be called with grad mode enabled.
+    """
+    def __init__(self, solver, image_layout):
+        super().__init__()
+        priors = getattr(solver.prior_cost, 'priors', [solver.prior_cost])
+        self.priors = torch.nn.ModuleList([ScriptableBilinAE(prior) for prior in priors])
+        self.grad_mod = ScriptableConvLstm(solver.grad_mod)
+        self.n_step = solver.n_step
+        self.lr_grad = float(solver.lr_grad)
+        self.obs_w = float(getattr(solver, 'lbd', 1.)**2 * getattr(solver.obs_cost, 'w', 1.))
+        self.image_layout = image_layout
+
+    def forward_ae(self, x):
+        out = torch.zeros_like(x)
+        for prior in self.priors:
+            out = out + prior(x)
+        return out / len(self.priors)
+
+    def var_cost(self, state, obs, msk):
+        cost = self.obs_w * ((state - obs)**2 * msk).sum() / msk.sum()
+        for prior in self.priors:
+            cost = cost + F.mse_loss(state, prior(state))
+        return cost
+
+    def forward(self, inp, init):
+        # 'b c t -> b t c ()' or 'b c t -> b t c' once for the whole loop
+        inp, state = inp.transpose(1, 2).contiguous(), init.nan_to_num().transpose(1, 2).contiguous()
+        if self.image_layout:
+            inp, state = inp.unsqueeze(-1), state.unsqueeze(-1)
+        msk = inp.isfinite().to(inp.dtype)
+        obs = inp.nan_to_num()
+
+        hidden, cell = self.grad_mod.init_state(inp)
+        grad_norm: Optional[torch.Tensor] = None
+        # TorchScript has no enable_grad: the module has to be called with grad mode enabled
+        assert torch.is_grad_enabled(), "the exported solver computes gradients, call it outside no_grad"
+        for step in range(self.n_step):
+            state = state.detach().requires_grad_(True)
+            grad = torch.autograd.grad([self.var_cost(state, obs, msk)], [state])[0]
+            assert grad is not None
+            if grad_norm is None:
+                grad_norm = (grad**2).mean().sqrt()
+            gmod, hidden, cell = self.grad_mod(grad, hidden, cell, grad_norm)
+            state = state - (1 / (step + 1) * gmod + self.lr_grad * (step + 1) / self.n_step * grad)
+
+        out = self.forward_ae(state.detach())
+        if self.image_layout:
+            out = out.squeeze(-1)
+        return out.transpose(1, 2)
+
+
+def export_solver(solver, path=None):
+    """
+    Script the inference graph of `solver`, sharing its parameters (optionally saved to `path`).
+
+    The priors and the grad model have to use the default 'b c t -> b t c ()' (`Rearranged*`)
+    or 'b c t -> b t c' (`Conv1d*`) layouts, and the observation cost has to be a plain
+    `src.models.BaseObsCost`.
+
+    Returns:
+        torch.jit.ScriptModule: The scripted solver, `module(input, init) -> output`.
+    """
+    priors = getattr(solver.prior_cost, 'priors', [solver.prior_cost])
+    layouts = {getattr(mod, 'rearrange_bef', None) for mod in [*priors, solver.grad_mod]}
+    if layouts not in ({'b c t -> b t c ()'}, {'b c t -> b t c'}):
+        raise NotImplementedError(f"Unsupported prior and grad model layouts {layouts}")
+    if type(solver.obs_cost) is not src.models.BaseObsCost:  # pylint: disable=unidiomatic-typecheck
+        raise NotImplementedError(f"Unsupported observation cost {type(solver.obs_cost).__name__}")
+    module = torch.jit.script(ScriptableSolver(solver, image_layout=layouts == {'b c t -> b t c ()'}).eval())
+    if path is not None:
+        torch.jit.save(module, path)
+    return module
+
+
+def load_solver(path, map_location='cpu'):
+    """ Load a solver saved by `export_solver`. """
+    return torch.jit.load(path, map_location=map_location).eval()
+
+
+def main(argv=None):
+    """ Export the solver of a `LitLorenz` (or `SolverWithInit`) module pickled with `torch.save`. """
+    parser = argparse.ArgumentParser(description="Export a lorenz63 solver to TorchScript")
+    parser.add_argument('checkpoint', help="pickled LitLorenz / SolverWithInit module")
+    parser.add_argument('output', help="TorchScript file")
+    args = parser.parse_args(argv)
+
+    model = torch.load(args.checkpoint, map_location='cpu', weights_only=False)
+    export_solver(getattr(model, 'solver', model).eval(), args.output)
+    print(f"Exported solver to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,49 @@
+import collections
+import re
+import time
 import src.models
 import xarray as xr
 import numpy as np
 import kornia.filters as kfilts
 import torch
+import torch.utils.checkpoint
+import torchmetrics
 import einops
+import einops.layers.torch
 import contrib.lorenz63
+import contrib.lorenz63.data as l63_data
 
 
 
+def _n_axes(pattern):
+    """ Number of axes of one side of an einops pattern, e.g. 3 for 'b t c ()'. """
+    return len(re.findall(r'\([^)]*\)|\S+', pattern))
+
+
+class _Rearrange(torch.nn.Module):
+    """
+    Precompiled rearrangement between the `rearrange_from` and `rearrange_to` layouts.
+
+    Inputs already in the `rearrange_to` layout (identified by their number of axes) are
+    passed through, so that a solver can keep its state in that layout across iterations.
+    """
+    def __init__(self, rearrange_from, rearrange_to):
+        super().__init__()
+        self.bef = einops.layers.torch.Rearrange(rearrange_from + ' -> ' + rearrange_to)
+        self.aft = einops.layers.torch.Rearrange(rearrange_to + ' -> ' + rearrange_from)
+        self.n_axes_from = _n_axes(rearrange_from)
+        self.passthrough = self.n_axes_from != _n_axes(rearrange_to)
+
+    def is_rearranged(self, x):
+        return self.passthrough and x.ndim != self.n_axes_from
+
+    def forward(self, x):
+        return x if self.is_rearranged(x) else self.bef(x)
+
+    def inverse(self, x, was_rearranged=False):
+        return x if was_rearranged else self.aft(x)
+
+
 class RearrangedBilinAEPriorCost(src.models.BilinAEPriorCost):
     """
     Wrapper around the base prior cost that allows for reshaping of the input batch
@@ -17,31 +53,370 @@ class RearrangedBilinAEPriorCost(src.models.BilinAEPriorCost):
         super().__init__(*args, **kwargs)
         self.rearrange_bef = rearrange_from + ' -> ' + rearrange_to
         self.rearrange_aft = rearrange_to + ' -> ' + rearrange_from
+        self._rearrange = _Rearrange(rearrange_from, rearrange_to)
 
     def forward_ae(self, x):
-        x = einops.rearrange(x, self.rearrange_bef)
-        x = super().forward_ae(x)
-        x = einops.rearrange(x, self.rearrange_aft)
-        return x
+        rearranged = self._rearrange.is_rearranged(x)
+        x = super().forward_ae(self._rearrange(x))
+        return self._rearrange.inverse(x, rearranged)
+
+def _architecture_key(module):
+    """ Hashable description of a module's architecture: submodule types, public attributes and tensor shapes. """
+    return (
+        tuple(
+            (name, type(mod).__name__, tuple(sorted(
+                (k, repr(v)) for k, v in vars(mod).items() if not k.startswith('_') and k != 'training'
+            )))
+            for name, mod in module.named_modules()
+        ),
+        tuple((name, tuple(p.shape), p.dtype) for name, p in module.named_parameters()),
+        tuple((name, tuple(b.shape), b.dtype) for name, b in module.named_buffers()),
+    )
+
+
+class _MethodCall(torch.nn.Module):
+    """ Exposes `module.<method>` as `forward` for `torch.func.functional_call`. """
+    def __init__(self, module, method):
+        super().__init__()
+        self.module = module
+        self.method = method
+
+    def forward(self, *args):
+        return getattr(self.module, self.method)(*args)
+
 
 class MultiPrior(torch.nn.Module):
-    def __init__(self, *priors) -> None:
+    """
+    Average of several prior costs.
+
+    By default the priors are evaluated one after the other and their outputs accumulated
+    on the fly. With `fused=True` priors sharing the same architecture are evaluated in a
+    single `torch.func.vmap` call over their stacked parameters (the parameters stay owned
+    by each prior, so checkpoints and optimizers are unchanged).
+    """
+    def __init__(self, *priors, fused=False) -> None:
         super().__init__()
         self.priors = torch.nn.ModuleList(priors)
+        self.fused = fused
+        self._groups = None
+
+    def prior_groups(self):
+        """ Priors grouped by architecture, computed once. """
+        if self._groups is None:
+            groups = {}
+            for prior in self.priors:
+                groups.setdefault(_architecture_key(prior), []).append(prior)
+            self._groups = list(groups.values())
+        return self._groups
+
+    def _fused_call(self, method, x):
+        outs = []
+        for group in self.prior_groups():
+            if len(group) == 1:
+                outs.append(getattr(group[0], method)(x)[None])
+                continue
+            named = [dict(prior.named_parameters()) for prior in group]
+            params = {f'module.{name}': torch.stack([p[name] for p in named]) for name in named[0]}
+            named = [dict(prior.named_buffers()) for prior in group]
+            buffers = {f'module.{name}': torch.stack([b[name] for b in named]) for name in named[0]}
+            call = _MethodCall(group[0], method)
+            outs.append(torch.func.vmap(
+                lambda p, b, x: torch.func.functional_call(call, (p, b), (x,)), in_dims=(0, 0, None)
+            )(params, buffers, x))
+        return torch.cat(outs)
 
     def forward_ae(self, x):
-        return torch.mean(torch.stack([prior.forward_ae(x) for prior in self.priors],0), 0)
+        if self.fused:
+            return self._fused_call('forward_ae', x).mean(0)
+        out = None
+        for prior in self.priors:
+            out = prior.forward_ae(x) if out is None else out + prior.forward_ae(x)
+        return out / len(self.priors)
 
     def forward(self, x):
-        return torch.sum(torch.stack([prior.forward(x) for prior in self.priors]))
+        if self.fused:
+            return self._fused_call('forward', x).sum()
+        return sum(prior.forward(x) for prior in self.priors)
+
+
+def dyn_lorenz63_torch(x, sigma=10., rho=28., beta=8./3):
+    """ Torch version of `data.dyn_lorenz63` on (batch, component, ...) tensors. """
+    x_1, x_2, x_3 = x.unbind(1)
+    return torch.stack([sigma * (x_2 - x_1), x_1 * (rho - x_3) - x_2, x_1 * x_2 - beta * x_3], dim=1)
+
+
+def rk4_lorenz63(x, dt, n_sub=1, **dyn_kw):
+    """ Differentiable Lorenz-63 forecast of (batch, component, ...) states over `dt`, in `n_sub` RK4 steps. """
+    h = dt / n_sub
+    for _ in range(n_sub):
+        k1 = dyn_lorenz63_torch(x, **dyn_kw)
+        k2 = dyn_lorenz63_torch(x + h/2 * k1, **dyn_kw)
+        k3 = dyn_lorenz63_torch(x + h/2 * k2, **dyn_kw)
+        k4 = dyn_lorenz63_torch(x + h * k3, **dyn_kw)
+        x = x + h/6 * (k1 + 2*k2 + 2*k3 + k4)
+    return x
+
+
+class LorenzDynCost(torch.nn.Module):
+    """
+    Dynamics consistency cost: mean squared difference between each state and the RK4
+    forecast of the previous one, all time steps of the batch being forecast at once.
+
+    Args:
+        dt (float): Time step between consecutive states.
+        norm_stats (tuple): (mean, std) of the normalized states, the cost is in normalized units.
+        layout (str): Layout of rearranged states ('b t c ()' for the `Rearranged*` modules
+            with solver level rearrangement), states with the 'b c t' number of axes are used as is.
+        n_sub (int): RK4 steps per time step.
+        **dyn_kw: Parameters of `dyn_lorenz63_torch`.
+    """
+    def __init__(self, dt=0.01, norm_stats=(0., 1.), layout='b t c ()', n_sub=1, **dyn_kw):
+        super().__init__()
+        self.dt = dt
+        self.norm_stats = norm_stats
+        self.n_sub = n_sub
+        self.dyn_kw = dyn_kw
+        self._rearrange = _Rearrange('b c t', layout)
+
+    def residual(self, x):
+        x = self._rearrange.inverse(x, not self._rearrange.is_rearranged(x))
+        mean, std = self.norm_stats
+        x = x * std + mean
+        return (rk4_lorenz63(x[..., :-1], self.dt, self.n_sub, **self.dyn_kw) - x[..., 1:]) / std
+
+    def cost_per_sample(self, x):
+        return self.residual(x).pow(2).flatten(1).mean(1)
+
+    def forward(self, x):
+        return self.residual(x).pow(2).mean()
+
+
+class DynRegularizedPrior(torch.nn.Module):
+    """
+    Prior cost (e.g. a `MultiPrior`) with an additional weighted `LorenzDynCost` term.
+    `forward_ae` is the one of the prior.
+    """
+    def __init__(self, prior, dyn_cost, weight=1.):
+        super().__init__()
+        self.prior = prior
+        self.dyn_cost = dyn_cost
+        self.weight = weight
+
+    def forward_ae(self, x):
+        return self.prior.forward_ae(x)
+
+    def forward(self, x):
+        return self.prior(x) + self.weight * self.dyn_cost(x)
+
+
+def prior_cost_per_sample(prior, x):
+    """ Per sample cost of a (`MultiPrior` of) mean squared autoencoder error prior(s), with their dynamics cost. """
+    if isinstance(prior, MultiPrior):
+        return sum(prior_cost_per_sample(p, x) for p in prior.priors)
+    if isinstance(prior, DynRegularizedPrior):
+        return prior_cost_per_sample(prior.prior, x) + prior.weight * prior.dyn_cost.cost_per_sample(x)
+    return (x - prior.forward_ae(x)).pow(2).flatten(1).mean(1)
+
+
+def _has_prior_cost_per_sample(prior):
+    """ Whether `prior_cost_per_sample` computes the per sample terms of `prior`'s cost. """
+    if isinstance(prior, MultiPrior):
+        return all(_has_prior_cost_per_sample(p) for p in prior.priors)
+    if isinstance(prior, DynRegularizedPrior):
+        return _has_prior_cost_per_sample(prior.prior) and hasattr(prior.dyn_cost, 'cost_per_sample')
+    return isinstance(prior, src.models.BilinAEPriorCost) and type(prior).forward is src.models.BilinAEPriorCost.forward
 
 
 class SolverWithInit(src.models.GradSolver):
+    """
+    Gradient solver initialized from the interpolated observations (`batch.init`).
+
+    When `rearrange_from` and `rearrange_to` are given (e.g. 'b c t' and 'b t c ()' as in the
+    rearranged prior and grad model), the state and the batch are rearranged once before the
+    unrolled loop and the output once after it, instead of at every prior and grad model call.
+
+    The memory of the unrolled loop during training can be reduced with `grad_checkpoint`
+    (the activations of each iteration are recomputed in the backward pass) and `n_step_grad`
+    (truncated backprop: only the last `n_step_grad` iterations are tracked by autograd).
+
+    With a `warm_start` store (`warm_start.WarmStartStore`) and batches carrying their
+    dataset indices (`idx` field), training iterations start from the previous output of
+    each item instead of `batch.init`, and store their output for the next time.
+
+    With `early_stop_tol`, inference stops iterating on each sample once the relative
+    decrease of its variational cost falls below the tolerance (tested from iteration
+    `early_stop_min_step` on, as the step size ramps up over the iterations); converged samples
+    are removed from the following iterations and `n_iter` holds the iterations run for each sample.
+    Only the costs whose per sample terms are known are supported: autoencoder priors (see
+    `prior_cost_per_sample`) and a plain `src.models.BaseObsCost`.
+    """
+    def __init__(self, *args, rearrange_from=None, rearrange_to=None, grad_checkpoint=False, n_step_grad=None,
+                 warm_start=None, early_stop_tol=None, early_stop_min_step=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        if rearrange_from is not None and _n_axes(rearrange_from) == _n_axes(rearrange_to):
+            raise ValueError(
+                "Solver level rearrangement needs layouts with different numbers of axes, "
+                f"got '{rearrange_from}' and '{rearrange_to}'"
+            )
+        self._rearrange = (
+            None if rearrange_from is None else _Rearrange(rearrange_from, rearrange_to)
+        )
+        self.grad_checkpoint = grad_checkpoint
+        self.n_step_grad = n_step_grad
+        self.warm_start = warm_start
+        if early_stop_tol is not None:
+            if type(self.obs_cost) is not src.models.BaseObsCost:  # pylint: disable=unidiomatic-typecheck
+                raise NotImplementedError(f"Early stopping does not support {type(self.obs_cost).__name__}")
+            if not _has_prior_cost_per_sample(self.prior_cost):
+                raise NotImplementedError(f"Early stopping does not support {type(self.prior_cost).__name__}")
+        self.early_stop_tol = early_stop_tol
+        self.early_stop_min_step = early_stop_min_step
+
+        self.prior_costs = []
+        self.n_iter = None
+
+    def _uses_warm_start(self, batch):
+        return self.warm_start is not None and self.training and hasattr(batch, 'idx')
+
     def init_state(self, batch, x_init=None):
         if x_init is not None:
             return x_init
 
-        return batch.init.nan_to_num().detach().requires_grad_(True)
+        x_init = batch.init.nan_to_num()
+        if self._uses_warm_start(batch):
+            x_init, _ = self.warm_start.get(batch.idx, x_init)
+        return x_init.detach().requires_grad_(True)
+
+    def _step(self, state, batch, step):
+        """ `GradSolver.solver_step` also returning the prior cost of the state. """
+        prior_cost = self.prior_cost(state)
+        var_cost = prior_cost + getattr(self, 'lbd', 1.)**2 * self.obs_cost(state, batch)
+        grad = torch.autograd.grad(var_cost, state, create_graph=True)[0]
+
+        gmod = self.grad_mod(grad)
+        state_update = (
+            1 / (step + 1) * gmod
+            + self.lr_grad * (step + 1) / self.n_step * grad
+        )
+        return state - state_update, prior_cost
+
+    def solver_step(self, state, batch, step):
+        """ `GradSolver.solver_step` keeping the prior cost of each step in `self.prior_costs`. """
+        state, prior_cost = self._step(state, batch, step)
+        self.prior_costs.append(prior_cost if self.training else prior_cost.detach())
+        return state
+
+    def _checkpointed_step(self, state, batch, step):
+        """
+        `solver_step` under activation checkpointing. The recurrent state of the grad model is
+        passed explicitly so that the recomputation sees the same inputs as the forward.
+        """
+        def step_fn(state, *grad_mod_state):
+            self.grad_mod._state = list(grad_mod_state)
+            return (*self._step(state, batch, step), *self.grad_mod._state)
+
+        state, prior_cost, *grad_mod_state = torch.utils.checkpoint.checkpoint(
+            step_fn, state, *self.grad_mod._state, use_reentrant=False
+        )
+        self.grad_mod._state = grad_mod_state
+        self.prior_costs.append(prior_cost)
+        return state
+
+    def _detach(self, state):
+        """ Cut the autograd graph after an untracked iteration. """
+        if getattr(self.grad_mod, '_state', None) is not None:
+            self.grad_mod._state = [s.detach() for s in self.grad_mod._state]
+        if isinstance(getattr(self.grad_mod, '_grad_norm', None), torch.Tensor):
+            self.grad_mod._grad_norm = self.grad_mod._grad_norm.detach()
+        self.prior_costs[-1] = self.prior_costs[-1].detach()
+        return state.detach().requires_grad_(True)
+
+    def _unrolled(self, batch):
+        """ `GradSolver.forward` with optional checkpointed and truncated iterations. """
+        n_untracked = 0 if self.n_step_grad is None else max(self.n_step - self.n_step_grad, 0)
+        with torch.set_grad_enabled(True):
+            state = self.init_state(batch)
+            self.grad_mod.reset_state(batch.input)
+
+            for step in range(self.n_step):
+                tracked = self.training and step >= n_untracked
+                # the first iteration sets the grad model normalization, it is never recomputed
+                if tracked and self.grad_checkpoint and step > 0:
+                    state = self._checkpointed_step(state, batch, step)
+                else:
+                    state = self.solver_step(state, batch, step=step)
+                if not tracked:
+                    state = self._detach(state)
+
+            if self._uses_warm_start(batch):
+                self.warm_start.put(batch.idx, state)
+            if not self.training:
+                state = self.prior_cost.forward_ae(state)
+        return state
+
+    def _early_stopping_unrolled(self, batch):
+        """
+        Inference loop run on the samples which have not converged yet.
+
+        The gradients are those of the full batch costs: per sample costs are summed with the
+        normalization of the full batch means, and samples do not interact in the costs.
+        """
+        with torch.set_grad_enabled(True):
+            state = self.init_state(batch)
+            self.grad_mod.reset_state(batch.input)
+
+            out = state.detach().clone()
+            obs_msk = batch.input.isfinite()
+            obs = batch.input.nan_to_num()
+            n_batch, n_obs = out.shape[0], obs_msk.sum().clamp(min=1)
+            obs_w = getattr(self, 'lbd', 1.)**2 * getattr(self.obs_cost, 'w', 1.)
+            active = torch.arange(n_batch, device=out.device)
+            prev_cost = torch.full((n_batch,), float('inf'), device=out.device)
+            self.n_iter = torch.zeros(n_batch, dtype=torch.long, device=out.device)
+
+            for step in range(self.n_step):
+                prior_cost = prior_cost_per_sample(self.prior_cost, state)
+                obs_sse = ((state - obs[active])**2 * obs_msk[active]).flatten(1).sum(1)
+                self.prior_costs.append(prior_cost.sum().detach() / n_batch)
+
+                cost = (prior_cost + obs_w * obs_sse / obs_msk[active].flatten(1).sum(1).clamp(min=1)).detach()
+                keep = (step < self.early_stop_min_step) | (
+                    (prev_cost - cost) >= self.early_stop_tol * prev_cost.abs()
+                )
+                out[active[~keep]] = state[~keep].detach()
+                if not keep.any():
+                    active, state = active[keep], state[keep]
+                    break
+
+                var_cost = prior_cost[keep].sum() / n_batch + obs_w * obs_sse[keep].sum() / n_obs
+                grad = torch.autograd.grad(var_cost, state)[0][keep]
+                if getattr(self.grad_mod, '_state', None) is not None:
+                    self.grad_mod._state = [s[keep] for s in self.grad_mod._state]
+                gmod = self.grad_mod(grad)
+                state = state[keep].detach() - (
+                    1 / (step + 1) * gmod
+                    + self.lr_grad * (step + 1) / self.n_step * grad
+                )
+                state = state.detach().requires_grad_(True)
+                active, prev_cost = active[keep], cost[keep]
+                self.n_iter[active] += 1
+
+            out[active] = state.detach()
+            return self.prior_cost.forward_ae(out)
+
+    def forward(self, batch):
+        self.prior_costs = []
+        batch = l63_data.densify_batch(batch)
+        if self._rearrange is not None and not self._rearrange.is_rearranged(batch.input):
+            batch = batch._replace(**{
+                field: self._rearrange(getattr(batch, field)).contiguous()
+                for field in ('input', 'init') if field in batch._fields
+            })
+            return self._rearrange.inverse(self.forward(batch))
+
+        if self.early_stop_tol is not None and not self.training:
+            return self._early_stopping_unrolled(batch)
+        return self._unrolled(batch)
 
 class RearrangedConvLstmGradModel(src.models.ConvLstmGradModel):
     """
@@ -52,38 +427,240 @@ class RearrangedConvLstmGradModel(src.models.ConvLstmGradModel):
         super().__init__(*args, **kwargs)
         self.rearrange_bef = rearrange_from + ' -> ' + rearrange_to
         self.rearrange_aft = rearrange_to + ' -> ' + rearrange_from
+        self._rearrange = _Rearrange(rearrange_from, rearrange_to)
 
     def reset_state(self, inp):
-        inp = einops.rearrange(inp, self.rearrange_bef)
-        super().reset_state(inp)
+        super().reset_state(self._rearrange(inp))
 
     def forward(self, x):
-        x = einops.rearrange(x, self.rearrange_bef)
-        x = super().forward(x)
-        x = einops.rearrange(x, self.rearrange_aft)
-        return x
+        rearranged = self._rearrange.is_rearranged(x)
+        x = super().forward(self._rearrange(x))
+        return self._rearrange.inverse(x, rearranged)
+
+
+
+def _to_conv1d(module):
+    """ Replace in place the 2-D conv, pooling and upsampling layers of `module` by their 1-D counterparts. """
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Conv2d):
+            child = torch.nn.Conv1d(
+                child.in_channels, child.out_channels, child.kernel_size[0], padding=child.padding[0]
+            )
+        elif isinstance(child, torch.nn.AvgPool2d):
+            child = torch.nn.AvgPool1d(child.kernel_size)
+        elif isinstance(child, torch.nn.UpsamplingBilinear2d):
+            child = torch.nn.Upsample(scale_factor=child.scale_factor, mode='linear', align_corners=True)
+        setattr(module, name, child)
+    return module
+
+
+def conv1d_state_dict(state_dict):
+    """
+    Convert a state dict of a rearranged 2-D model ('b t c ()' layout) to its `Conv1d*` equivalent.
+
+    The 2-D kernels only ever see the middle column of their window along the singleton axis,
+    so that column holds the equivalent 1-D kernel.
+    """
+    return {
+        k: v[..., v.shape[-1] // 2] if k.endswith('weight') and v.ndim == 4 else v
+        for k, v in state_dict.items()
+    }
+
+
+class Conv1dBilinAEPriorCost(RearrangedBilinAEPriorCost):
+    """
+    `RearrangedBilinAEPriorCost` with `Conv1d` layers on a 'b t c' layout instead of `Conv2d`
+    layers on a 'b t c ()' fake image. Same arguments, same function, without the convolutions
+    over the singleton axis and its padding.
+    """
+    def __init__(self, rearrange_from='b c t', rearrange_to='b t c', *args, **kwargs):
+        super().__init__(rearrange_from, rearrange_to, *args, **kwargs)
+        _to_conv1d(self)
+
+
+class Conv1dConvLstmGradModel(RearrangedConvLstmGradModel):
+    """
+    `RearrangedConvLstmGradModel` with `Conv1d` layers on a 'b t c' layout instead of `Conv2d`
+    layers on a 'b t c ()' fake image.
+    """
+    def __init__(self, rearrange_from='b c t', rearrange_to='b t c', *args, **kwargs):
+        super().__init__(rearrange_from, rearrange_to, *args, **kwargs)
+        _to_conv1d(self)
 
+    def reset_state(self, inp):
+        inp = self._rearrange(inp)
+        size = [inp.shape[0], self.dim_hidden, inp.shape[-1]]
+        self._grad_norm = None
+        self._state = [
+            self.down(torch.zeros(size, device=inp.device)),
+            self.down(torch.zeros(size, device=inp.device)),
+        ]
+
+
+class PatchMetrics(torchmetrics.Metric):
+    """
+    Running test metrics over (denormalized) output and target patches.
+
+    Only sums are kept, so memory does not depend on the number of batches, `compute` can be
+    called at any time, and states are summed across processes in distributed runs.
+
+    Args:
+        crop (int): Number of time steps removed at both ends of the patches for `crop_mse`.
+    """
+    full_state_update = False
+
+    def __init__(self, crop=20, **kwargs):
+        super().__init__(**kwargs)
+        self.crop = crop
+        for name in ['sse', 'energy', 'count', 'crop_sse', 'crop_count']:
+            self.add_state(name, default=torch.tensor(0., dtype=torch.float64), dist_reduce_fx='sum')
+
+    def update(self, out, tgt):
+        sq_err = ((tgt - out)**2).double()
+        valid = sq_err.isfinite()
+        self.sse += sq_err[valid].sum()
+        self.energy += tgt.double()[valid].pow(2).sum()
+        self.count += valid.sum()
+        crop = slice(self.crop, -self.crop or None)
+        self.crop_sse += sq_err[..., crop][valid[..., crop]].sum()
+        self.crop_count += valid[..., crop].sum()
+
+    def compute(self):
+        return dict(
+            mse=self.sse / self.count,
+            percent_err=self.sse / self.energy,
+            crop_mse=self.crop_sse / self.crop_count,
+        )
 
 
 class LitLorenz(src.models.Lit4dVarNet):
+    """
+    Args:
+        grad_loss_weight (float): Weight of the Sobel gradient loss, skipped when 0.
+        reuse_prior_cost (bool): Use the prior cost computed at the last solver iteration
+            instead of evaluating the prior again on the output. Saves a prior evaluation per
+            step but changes the training objective: the reused cost is the one of the state
+            before the last update and before the final `forward_ae`, not of the output.
+        crop (int): Time steps removed at both ends of the patches for the cropped patch MSE.
+        store_test_data (bool): Keep the test batches to reconstruct the test set at the end of
+            the epoch (metrics on the reconstruction, `test_data.nc`). When False only the
+            streaming `patch_metrics` are computed.
+
+    Batches with `SparseObs` inputs are densified after their transfer to the device.
+    """
+    def __init__(self, *args, grad_loss_weight=0., reuse_prior_cost=False, crop=20, store_test_data=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.grad_loss_weight = grad_loss_weight
+        self.reuse_prior_cost = reuse_prior_cost
+        self.store_test_data = store_test_data
+        self.patch_metrics = PatchMetrics(crop=crop)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        return l63_data.densify_batch(batch)
+
     def step(self, batch, phase="", opt_idx=None):
+        start = time.perf_counter()
         loss, out = super().base_step(batch, phase)
-        prior_cost = self.solver.prior_cost(self.solver.init_state(batch, out))
-        grad_loss = self.weighted_mse( kfilts.sobel(out[..., None]).squeeze()
-            - kfilts.sobel(batch.tgt[..., None]).squeeze(), self.rec_weight)
-        return  loss + prior_cost, out
+        if out.is_cuda:
+            torch.cuda.synchronize(out.device)
+        forward_time = time.perf_counter() - start
+
+        if self.reuse_prior_cost and self.solver.prior_costs:
+            prior_cost = self.solver.prior_costs[-1]
+        else:
+            prior_cost = self.solver.prior_cost(self.solver.init_state(batch, out))
+        loss = loss + prior_cost
+
+        if self.grad_loss_weight:
+            grad_loss = self.weighted_mse( kfilts.sobel(out[..., None]).squeeze()
+                - kfilts.sobel(batch.tgt[..., None]).squeeze(), self.rec_weight)
+            self.log(f"{phase}_gloss", grad_loss, prog_bar=True, on_step=False, on_epoch=True)
+            loss = loss + self.grad_loss_weight * grad_loss
+
+        self.log(f"{phase}_forward_time", forward_time, on_step=True, on_epoch=True)
+        self.log(f"{phase}_step_time", time.perf_counter() - start, on_step=True, on_epoch=True)
+        return loss, out
     
+    def test_step(self, batch, batch_idx):
+        if self.store_test_data:
+            super().test_step(batch, batch_idx)
+            _, tgt, out = self.test_data[-1].unbind(1)
+        else:
+            m, s = self.norm_stats
+            tgt, out = batch.tgt * s + m, self(batch=batch).detach() * s + m
+        self.patch_metrics.update(out.to(self.patch_metrics.device), tgt.to(self.patch_metrics.device))
+
     def on_test_epoch_end(self):
-        crop = 20
+        patch_metrics = {k: v.item() for k, v in self.patch_metrics.compute().items()}
+        self.patch_metrics.reset()
+        print('\n\nPATCH MSE', patch_metrics['crop_mse'], '\n\n')
+        self.log_dict({f'test_patch_{k}': v for k, v in patch_metrics.items()})
+        if not self.store_test_data:
+            print(patch_metrics['mse'])
+            print(patch_metrics['percent_err'])
+            return
 
-        test_data = torch.cat([td[..., crop:-crop] for td in self.test_data])
-        print('\n\nPATCH MSE', ((test_data[:, 1] - test_data[:, 2])**2).mean(), '\n\n')
         super().on_test_epoch_end()
 
-        test_data = self.pre_metric_fn(self.test_data)
-        print(mse(test_data))
-        print(percent_err(test_data))
+        test_metrics = rec_metrics(self.pre_metric_fn(self.test_data))
+        print(test_metrics.mse.item())
+        print(test_metrics.percent_err.item())
+
+
+Metrics = collections.namedtuple('Metrics', [
+    'mse', 'rmse', 'percent_err', 'component_mse', 'component_percent_err', 'lead_time_mse', 'spectral_err'
+])
+
+
+def metrics(out, tgt):
+    """
+    Reconstruction errors of Lorenz trajectories in one vectorized pass.
+
+    Args:
+        out, tgt (np.ndarray | torch.Tensor): Arrays of shape (..., component, time); with
+            patches (batch, component, time) the time axis is the lead time within the patch.
+            Non finite errors are ignored.
+
+    Returns:
+        Metrics: Scalar `mse`, `rmse` and `percent_err` (mse over target energy), per component
+        `component_mse` and `component_percent_err`, per time step `lead_time_mse`, and per
+        frequency `spectral_err` (error over target power spectrum along time).
+    """
+    out, tgt = (np.asarray(a.detach().cpu()) if isinstance(a, torch.Tensor) else np.asarray(a) for a in (out, tgt))
+    err = out - tgt
+    valid = np.isfinite(err)
+    if not valid.all():
+        err = np.where(valid, err, 0.)
+        tgt = np.where(valid, tgt, 0.)
+
+    n_comp, n_time = err.shape[-2:]
+    # single reduction of the leading axes, everything else is derived from (component, time) sums
+    sse, energy, count = (
+        a.reshape(-1, n_comp, n_time).sum(0, dtype=np.float64) for a in (err**2, tgt**2, valid)
+    )
+    mse_ = sse.sum() / count.sum()
+    err_psd, tgt_psd = (
+        (np.abs(np.fft.rfft(a, axis=-1))**2).reshape(-1, n_time // 2 + 1).sum(0) for a in (err, tgt)
+    )
+    return Metrics(
+        mse=mse_,
+        rmse=np.sqrt(mse_),
+        percent_err=sse.sum() / energy.sum(),
+        component_mse=sse.sum(1) / count.sum(1),
+        component_percent_err=sse.sum(1) / energy.sum(1),
+        lead_time_mse=sse.sum(0) / count.sum(0),
+        spectral_err=err_psd / tgt_psd,
+    )
+
+
+def rec_metrics(rec_ds):
+    """ `metrics` of a reconstructed test dataset with `out` and `tgt` variables. """
+    out, tgt = (
+        rec_ds[v].transpose(..., 'component', 'time') if {'component', 'time'} <= set(rec_ds[v].dims) else rec_ds[v]
+        for v in ('out', 'tgt')
+    )
+    return metrics(out.values, tgt.values)
 
 
-def mse(rec_ds): return ((rec_ds.tgt - rec_ds.out)**2).mean().values.item()
-def percent_err(rec_ds): return (np.mean((rec_ds.tgt - rec_ds.out)**2)/np.mean(rec_ds.tgt**2)).mean().values.item()
+def mse(rec_ds): return rec_metrics(rec_ds).mse.item()
+def percent_err(rec_ds): return rec_metrics(rec_ds).percent_err.item()
@@ -1,11 +1,27 @@
 """
 Pytest configuration file for the test suite.
 
-This file ensures that the root directory of the project is added to the
-PYTHONPATH, allowing the test suite to import modules from the `scripts` package.
+This file ensures that the contribution directory and the root directory of the
+project are added to the PYTHONPATH, allowing the test suite to import both the
+contribution modules and the `contrib.lorenz63` package they depend on.
+It also provides the random masked `batch` fixture shared by the model tests.
 """
 
 import sys
 import os
+import pytest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
+
+
+@pytest.fixture
+def batch():
+    """ Random (4, 3, 20) targets observed with probability 0.5, as a `TrainingItemWithInit`. """
+    import torch  # pylint: disable=import-outside-toplevel
+    import contrib.lorenz63.data as l63_data  # pylint: disable=import-outside-toplevel
+
+    torch.manual_seed(1)
+    tgt = torch.randn(4, 3, 20)
+    inp = torch.where(torch.rand_like(tgt) < 0.5, tgt, torch.full_like(tgt, float('nan')))
+    return l63_data.TrainingItemWithInit(input=inp, tgt=tgt, init=inp.nan_to_num())
@@ -0,0 +1,58 @@
+"""Unit tests for the lorenz63 data assimilation baselines"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+pytest.importorskip("kornia")
+pytest.importorskip("xarray")
+pytest.importorskip("src.models")
+
+import contrib.lorenz63.baselines as l63_baselines  # pylint: disable=wrong-import-position
+import contrib.lorenz63.models as l63_models  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def states():
+    torch.manual_seed(0)
+    return torch.randn(4, 3, dtype=torch.float64) * 5 + torch.tensor([0., 0., 25.], dtype=torch.float64)
+
+
+def test_tangent_linear_and_adjoint(states):
+    _, points = l63_baselines.rk4_stage_points(states, 0.01)
+    dx, lx = torch.randn_like(states), torch.randn_like(states)
+    tl = l63_baselines.tl_rk4_step(points, dx, 0.01)
+    ref = torch.func.jvp(lambda x: l63_models.rk4_lorenz63(x, 0.01), (states,), (dx,))[1]
+    torch.testing.assert_close(tl, ref)
+    torch.testing.assert_close((tl * lx).sum(), (dx * l63_baselines.adj_rk4_step(points, lx, 0.01)).sum())
+
+    traj, points = l63_baselines.forecast(states, 30, 0.01)
+    torch.testing.assert_close(traj[..., 1], l63_models.rk4_lorenz63(states, 0.01))
+    jacs = l63_baselines.step_jacobians(points, 0.01)
+    ref = torch.func.jvp(lambda x: l63_baselines.forecast(x, 30, 0.01)[0], (states,), (dx,))[1]
+    torch.testing.assert_close(l63_baselines._tl_sweep(jacs, dx), ref)  # pylint: disable=protected-access
+
+
+def _windows(states, n_time=50, sample_step=5):
+    tgt, _ = l63_baselines.forecast(states, n_time, 0.01)
+    obs = torch.full_like(tgt, float('nan'))
+    obs[:, 0, ::sample_step] = tgt[:, 0, ::sample_step] + 0.1 * torch.randn_like(tgt[:, 0, ::sample_step])
+    return obs, tgt
+
+
+def test_fourdvar(states):
+    obs, tgt = _windows(states)
+    background = states + torch.randn_like(states)
+    obs[-1] = float('nan')
+    out = l63_baselines.fourdvar(obs, background, obs_sigma=0.1)
+    assert ((out - tgt)[:-1]**2).mean() < 0.01 * ((background - states)**2).mean()
+    torch.testing.assert_close(out[-1], l63_baselines.forecast(background, 50, 0.01)[0][-1])
+
+
+def test_enkf(states):
+    obs, tgt = _windows(states)
+    background = states + torch.randn_like(states)
+    out = l63_baselines.enkf(obs, background, n_members=64, obs_sigma=0.1, seed=0)
+    torch.testing.assert_close(out, l63_baselines.enkf(obs, background, n_members=64, obs_sigma=0.1, seed=0))
+    free_run, _ = l63_baselines.forecast(background, 50, 0.01)
+    assert ((out - tgt)[..., -10:]**2).mean() < 0.1 * ((free_run - tgt)[..., -10:]**2).mean()
@@ -0,0 +1,67 @@
+"""Unit tests for the lorenz63 dataset cache"""
+
+import functools as ft
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("xarray")
+pytest.importorskip("scipy")
+pytest.importorskip("torch")
+pytest.importorskip("src.data")
+
+import contrib.lorenz63.data as l63_data  # pylint: disable=wrong-import-position
+import contrib.lorenz63.cache as l63_cache  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def gen_kw():
+    return dict(
+        fn=l63_data.dyn_lorenz63, y0=[8., 0., 30.],
+        solver_kw=dict(t_span=[0.01, 5.01], t_eval=np.arange(0.01, 5.01, 0.01), first_step=0.01, method='RK45'),
+        obs_fn=lambda da: l63_data.add_noise(l63_data.subsample(l63_data.only_first_obs(da), 20), 2.),
+    )
+
+
+def test_cached_training_da_hit(tmp_path, gen_kw):
+    np.random.seed(1)
+    first = l63_cache.cached_training_da(**gen_kw, seed=0, cache_dir=str(tmp_path))
+    assert np.random.randint(2**32) == np.random.RandomState(1).randint(2**32)  # caller state untouched
+    second = l63_cache.cached_training_da(**gen_kw, seed=0, cache_dir=str(tmp_path))
+    assert isinstance(second.data, np.memmap)
+    assert second.dims == ('variable', 'component', 'time')
+    np.testing.assert_array_equal(first.values, second.values)
+    assert len(l63_cache.list_entries(str(tmp_path))) == 1
+
+    l63_cache.cached_training_da(**gen_kw, seed=1, cache_dir=str(tmp_path))
+    assert len(l63_cache.list_entries(str(tmp_path))) == 2
+
+
+def test_cache_key_depends_on_obs_chain():
+    assert (
+        l63_cache.cache_key(obs_fn=ft.partial(l63_data.subsample, sample_step=10))
+        != l63_cache.cache_key(obs_fn=ft.partial(l63_data.subsample, sample_step=20))
+    )
+    assert (
+        l63_cache.cache_key(solver_kw=dict(t_eval=np.arange(10.)))
+        != l63_cache.cache_key(solver_kw=dict(t_eval=np.arange(11.)))
+    )
+
+
+def test_evict_least_recently_used(tmp_path, gen_kw):
+    for seed in range(3):
+        l63_cache.cached_training_da(**gen_kw, seed=seed, cache_dir=str(tmp_path))
+    entries = l63_cache.list_entries(str(tmp_path))
+    l63_cache.main(['--dir', str(tmp_path), 'evict', str(1.5 * entries[0]['size'] / 2**20)])
+    assert [e['key'] for e in l63_cache.list_entries(str(tmp_path))] == [entries[-1]['key']]
+    l63_cache.main(['--dir', str(tmp_path), 'purge'])
+    assert not l63_cache.list_entries(str(tmp_path))
+
+
+def test_cache_key_of_random_generators():
+    obs_fn = lambda rng: l63_data.observation_fn(l63_data.mask_components, sigma=1., rng=rng)
+    key = lambda rng: l63_cache.cache_key(obs_fn=obs_fn(rng))
+    assert key(np.random.default_rng(0)) == key(np.random.default_rng(0))
+    assert key(np.random.default_rng(0)) != key(np.random.default_rng(1))
+    with pytest.raises(TypeError):
+        l63_cache.cache_key(obs_fn=ft.partial(l63_data.observe, rng=object()))
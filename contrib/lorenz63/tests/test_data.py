@@ -0,0 +1,406 @@
+"""Unit tests for lorenz63 data generation"""
+
+import functools as ft
+import gc
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("scipy")
+torch = pytest.importorskip("torch")
+src_data = pytest.importorskip("src.data")
+
+import contrib.lorenz63.data as l63_data  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def solver_kw():
+    return dict(t_span=[0.01, 2.01], t_eval=np.arange(0.01, 2.01, 0.01), first_step=0.01,
+                method='RK45', rtol=1e-9, atol=1e-12)
+
+
+@pytest.fixture
+def y0():
+    return np.array([8., 0., 30.]) + np.random.default_rng(0).normal(size=(4, 3))
+
+
+@pytest.mark.parametrize("method, first_step, tol", [('RK45', 0.01, 1e-5), ('RK4', 0.001, 1e-4)])
+def test_ensemble_trajectory_matches_trajectory_da(solver_kw, y0, method, first_step, tol):
+    ref = np.stack([l63_data.trajectory_da(l63_data.dyn_lorenz63, y, solver_kw).values for y in y0])
+    ens = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, y0, {**solver_kw, 'method': method, 'first_step': first_step}
+    )
+    assert ens.dims == ('member', 'component', 'time')
+    np.testing.assert_allclose(ens.time, solver_kw['t_eval'])
+    np.testing.assert_allclose(ens.values, ref, atol=tol)
+
+
+def test_ensemble_trajectory_warmup(solver_kw, y0):
+    ens = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, y0, solver_kw, warmup_kw=dict(t_span=[0.01, 1.01], t_eval=None)
+    )
+    assert ens.shape == (4, 3, 200)
+    assert not np.allclose(ens.isel(time=0).values, y0)
+
+
+def test_solve_ivp_batch_unknown_method(y0):
+    with pytest.raises(ValueError):
+        l63_data.solve_ivp_batch(l63_data.dyn_lorenz63, (0., 1.), y0, method='LSODA')
+
+
+@pytest.fixture
+def traj_da(solver_kw):
+    return l63_data.trajectory_da(l63_data.dyn_lorenz63, [8., 0., 30.], {**solver_kw, 't_span': [0.01, 10.01],
+                                                                         't_eval': np.arange(0.01, 10.01, 0.01)})
+
+
+def test_training_da_cubic_matches_griddata(traj_da):
+    obs_fn = lambda da: l63_data.subsample(l63_data.only_first_obs(da), sample_step=20)
+    ref = l63_data.training_da(traj_da, obs_fn, interp_method='griddata')
+    new = l63_data.training_da(traj_da, obs_fn)
+    assert new.dims == ref.dims
+    np.testing.assert_allclose(new.values, ref.values)
+
+
+@pytest.mark.parametrize("method", ['linear', 'cubic', 'akima'])
+def test_interpolate_time_series(method):
+    npa = np.full((2, 3, 41), np.nan)
+    npa[..., ::10] = np.arange(5.)
+    npa[1, 2] = np.nan
+    out = l63_data.interpolate_time_series(npa, method=method)
+    np.testing.assert_allclose(out[0, 0], np.linspace(0., 4., 41))
+    assert np.isnan(out[1, 2]).all()
+
+
+@pytest.mark.parametrize("method", ['linear', 'cubic', 'akima'])
+def test_interpolate_sparse_matches_dense(method):
+    npa = np.full((2, 3, 41), np.nan)
+    npa[..., ::10] = np.random.default_rng(0).normal(size=(2, 3, 5))
+    npa[1, 2] = np.nan
+    npa[0, 1, 7] = 1.
+    npa[1, 0, 3:] = np.nan
+    np.testing.assert_allclose(
+        l63_data.interpolate_sparse(l63_data.to_sparse(npa), method=method),
+        l63_data.interpolate_time_series(npa, method=method),
+    )
+
+
+@pytest.mark.parametrize("method, tol", [('linear', 1e-12), ('cubic', 1e-4)])
+def test_iter_training_da_matches_training_da(traj_da, method, tol):
+    obs_fn = lambda da: l63_data.subsample(l63_data.only_first_obs(da), sample_step=20)
+    ref = l63_data.training_da(traj_da, obs_fn, interp_method=method)
+    chunks = list(l63_data.iter_training_da(traj_da, obs_fn, chunk_size=200, interp_method=method))
+    assert len(chunks) == 5
+    assert all(chunk.sizes['time'] == 200 for chunk in chunks)
+    new = xr.concat(chunks, dim='time')
+    assert new.dims == ref.dims
+    np.testing.assert_allclose(new.values, ref.values, atol=tol)
+
+
+@pytest.fixture
+def datamodule_fn(traj_da):
+    input_da = l63_data.training_da(
+        traj_da, lambda da: l63_data.subsample(l63_data.only_first_obs(da), sample_step=20)
+    )
+    return lambda **kwargs: l63_data.LorenzDataModule(
+        input_da, domains={k: {'time': slice(None)} for k in ['train', 'val', 'test']},
+        xrds_kw=dict(patch_dims={'variable': 3, 'component': 3, 'time': 200}, strides={'time': 100}),
+        **{'dl_kw': dict(batch_size=4), **kwargs},
+    )
+
+
+def test_collate_norm_matches_post_fn(datamodule_fn):
+    dm, dm_collate = datamodule_fn(), datamodule_fn(collate_norm=True)
+    dm.setup()
+    dm_collate.setup()
+    for batch, batch_collate in zip(dm.val_dataloader(), dm_collate.val_dataloader()):
+        assert batch._fields == batch_collate._fields
+        for field, field_collate in zip(batch, batch_collate):
+            assert field.dtype == field_collate.dtype == torch.float32
+            torch.testing.assert_close(field, field_collate, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        datamodule_fn(collate_norm=True, aug_kw=dict(aug_factor=1))
+
+
+def obs_fn_with_noise(da):
+    return l63_data.add_noise(l63_data.subsample(l63_data.only_first_obs(da), sample_step=20), sigma=2.)
+
+
+def test_generate_ensemble_deterministic(tmp_path, solver_kw):
+    gen = lambda workers: l63_data.generate_ensemble(
+        3, l63_data.dyn_lorenz63, [8., 0., 30.], {**solver_kw, 'rtol': 1e-3, 'atol': 1e-6},
+        obs_fn_with_noise, seed=0, workers=workers, path=str(tmp_path / f'ens_{workers}.npy'),
+    )
+    serial, parallel = gen(1), gen(2)
+    assert serial.dims == ('member', 'variable', 'component', 'time')
+    assert serial.shape == (3, 3, 3, 200)
+    np.testing.assert_array_equal(serial.values, parallel.values)
+    assert not np.allclose(serial.sel(member=0).values, serial.sel(member=1).values, equal_nan=True)
+
+
+def test_generate_ensemble_removes_temporary_file(solver_kw):
+    ens = l63_data.generate_ensemble(2, l63_data.dyn_lorenz63, [8., 0., 30.], solver_kw, obs_fn_with_noise, workers=1)
+    path = ens.data.filename
+    assert os.path.isfile(path)
+    values = ens.values
+    del ens
+    gc.collect()
+    assert os.path.isfile(path)  # still mapped by a view
+    del values
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+def test_observation_fn_follows_global_seed(tmp_path, solver_kw):
+    obs_fn = l63_data.observation_fn(ft.partial(l63_data.mask_random, rate=0.2), sigma=1.)
+    gen = lambda workers, name: l63_data.generate_ensemble(
+        3, l63_data.dyn_lorenz63, [8., 0., 30.], {**solver_kw, 'rtol': 1e-3, 'atol': 1e-6},
+        obs_fn, seed=0, workers=workers, path=str(tmp_path / f'{name}.npy'),
+    ).values
+    np.random.seed(1)
+    first = gen(1, 'first')
+    assert np.random.randint(2**32) == np.random.RandomState(1).randint(2**32)  # caller state untouched
+    np.testing.assert_array_equal(first, gen(1, 'second'))
+    np.testing.assert_array_equal(first, gen(2, 'parallel'))
+
+
+def test_dyn_lorenz63_jit_and_jac():
+    x = np.array([[8., 1.], [0., -2.], [30., 25.]])
+    np.testing.assert_allclose(l63_data.dyn_lorenz63_jit(0., x), l63_data.dyn_lorenz63(0., x))
+    eps = 1e-6
+    fd_jac = np.stack([
+        (l63_data.dyn_lorenz63(0., x[:, 0] + eps * e) - l63_data.dyn_lorenz63(0., x[:, 0] - eps * e)) / (2 * eps)
+        for e in np.eye(3)
+    ], axis=1)
+    np.testing.assert_allclose(l63_data.jac_lorenz63(0., x[:, 0]), fd_jac, atol=1e-6)
+
+
+def test_trajectory_da_implicit_with_jac(solver_kw):
+    ref = l63_data.trajectory_da(l63_data.dyn_lorenz63, [8., 0., 30.], solver_kw)
+    new = l63_data.trajectory_da(
+        l63_data.dyn_lorenz63_jit, [8., 0., 30.], {**solver_kw, 'method': 'Radau', 'jac': l63_data.jac_lorenz63}
+    )
+    np.testing.assert_allclose(new.values, ref.values, atol=1e-4)
+
+
+def test_observe_matches_legacy_chain(traj_da):
+    ref = l63_data.subsample(l63_data.only_first_obs(traj_da), sample_step=20)
+    obs = l63_data.observation_fn(
+        l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=20)
+    )(traj_da)
+    assert obs.dims == ref.dims
+    np.testing.assert_array_equal(obs.values, ref.values)
+
+
+def test_observe_reproducible_noise_and_random_mask(traj_da):
+    obs_fn = lambda rng: l63_data.observation_fn(
+        ft.partial(l63_data.mask_random, rate=0.2), sigma=1., rng=rng
+    )(traj_da)
+    first, second = obs_fn(np.random.default_rng(0)), obs_fn(np.random.default_rng(0))
+    np.testing.assert_array_equal(first.values, second.values)
+    observed = np.isfinite(first.values)
+    assert (observed == observed[:1]).all()
+    assert 0.1 < observed[0].mean() < 0.3
+    assert not np.allclose(first.values[observed], traj_da.values[observed])
+
+
+@pytest.mark.parametrize("strides", [{'time': 1}, {'time': 7}])
+def test_window_dataset_matches_xr_dataset(traj_da, strides):
+    input_da = l63_data.training_da(traj_da, lambda da: l63_data.subsample(l63_data.only_first_obs(da), 20))
+    xrds_kw = dict(patch_dims={'variable': 3, 'component': 3, 'time': 50}, strides=strides)
+    ref, new = src_data.XrDataset(input_da, **xrds_kw), l63_data.WindowXrDataset(input_da, **xrds_kw)
+    assert len(new) == len(ref)
+    for i in [0, 1, len(ref) // 2, len(ref) - 1]:
+        assert new[i].dtype == np.float32
+        np.testing.assert_array_equal(new[i], ref[i])
+    assert [c.time.values[0] for c in new.get_coords()] == [c.time.values[0] for c in ref.get_coords()]
+
+
+def test_datamodule_window_index(datamodule_fn):
+    dm, dm_window = datamodule_fn(), datamodule_fn(window_index=True)
+    dm.setup()
+    dm_window.setup()
+    assert isinstance(dm_window.test_ds, l63_data.WindowXrDataset)
+    for batch, batch_window in zip(dm.test_dataloader(), dm_window.test_dataloader()):
+        for field, field_window in zip(batch, batch_window):
+            torch.testing.assert_close(field, field_window, equal_nan=True)
+
+
+def test_datamodule_tensor_backend(datamodule_fn):
+    dm, dm_tensor = datamodule_fn(), datamodule_fn(tensor_backend=True)
+    dm.setup()
+    dm_tensor.setup()
+    assert isinstance(dm_tensor.test_ds, l63_data.TensorXrDataset)
+    np.testing.assert_array_equal(
+        dm_tensor.test_ds[3].tgt.numpy(), dm.test_ds[3].tgt
+    )
+    batches, batches_tensor = list(dm.test_dataloader()), list(dm_tensor.test_dataloader())
+    assert len(batches) == len(batches_tensor)
+    for batch, batch_tensor in zip(batches, batches_tensor):
+        for field, field_tensor in zip(batch, batch_tensor):
+            torch.testing.assert_close(field, field_tensor, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        datamodule_fn(tensor_backend=True, aug_kw=dict(aug_factor=1))
+
+
+@pytest.mark.parametrize('backend_kw', [{}, dict(tensor_backend=True)])
+def test_datamodule_with_index(datamodule_fn, backend_kw):
+    dm = datamodule_fn(with_index=True, **backend_kw)
+    dm.setup()
+    assert isinstance(dm.train_ds, l63_data.IndexedDataset)
+    assert not isinstance(dm.val_ds, l63_data.IndexedDataset)
+    seen = []
+    for batch in dm.train_dataloader():
+        assert batch._fields == l63_data.IndexedTrainingItem._fields
+        for idx, tgt in zip(batch.idx.tolist(), batch.tgt):
+            torch.testing.assert_close(torch.as_tensor(dm.train_ds[idx].tgt), tgt)
+        seen += batch.idx.tolist()
+    assert sorted(seen) == list(range(len(dm.train_ds)))
+
+    with pytest.raises(ValueError):
+        datamodule_fn(with_index=True, collate_norm=True)
+
+
+def test_attractor_bank(tmp_path, solver_kw):
+    # short spin-up, so that the batched and scipy integrations have not diverged yet
+    warmup_kw = dict(t_span=[0.01, 0.51], t_eval=None)
+    bank = l63_data.attractor_bank(
+        l63_data.dyn_lorenz63, 16, solver_kw, warmup_kw, path=str(tmp_path / 'bank.npy')
+    )
+    assert bank.shape == (16, 3)
+    np.testing.assert_array_equal(l63_data.load_attractor_bank(str(tmp_path / 'bank.npy')), bank)
+    ref = [l63_data.trajectory_da(l63_data.dyn_lorenz63, y, solver_kw, warmup_kw).isel(time=0).values
+           for y in np.array([8., 0., 30.]) + np.random.default_rng(0).standard_normal((2, 3))]
+    np.testing.assert_allclose(bank[:2], ref, rtol=1e-3, atol=1e-3)
+
+    traj = l63_data.trajectory_da(l63_data.dyn_lorenz63, None, solver_kw, bank=bank, seed=3)
+    assert any(np.allclose(traj.isel(time=0).values, state) for state in bank)
+    ens = l63_data.ensemble_trajectory_da(l63_data.dyn_lorenz63, None, solver_kw, bank=bank, seed=3, n_members=4)
+    assert ens.shape == (4, 3, 200)
+    np.testing.assert_allclose(
+        ens.isel(time=0).values, l63_data.sample_attractor_states(bank, 4, seed=3), rtol=1e-10
+    )
+
+    with pytest.raises(ValueError):
+        l63_data.trajectory_da(l63_data.dyn_lorenz63, None, solver_kw, warmup_kw, bank=bank)
+    with pytest.raises(ValueError):
+        l63_data.ensemble_trajectory_da(l63_data.dyn_lorenz63, bank[:4], solver_kw, bank=bank, n_members=4)
+    with pytest.raises(ValueError):
+        l63_data.ensemble_trajectory_da(l63_data.dyn_lorenz63, None, solver_kw, bank=bank)
+
+
+def test_observation_fn_seed_draws_new_noise_per_call(traj_da):
+    mask_fns = (ft.partial(l63_data.mask_random, rate=0.2),)
+    obs_fn = l63_data.observation_fn(*mask_fns, sigma=1., rng=0)
+    first, second = obs_fn(traj_da), obs_fn(traj_da)
+    xr.testing.assert_equal(first, l63_data.observe(traj_da, mask_fns, sigma=1., rng=0))
+    assert not np.array_equal(first.notnull(), second.notnull())
+    assert not np.allclose(first.fillna(0.), second.fillna(0.))
+
+
+def test_sparse_observations_match_dense(traj_da):
+    mask_fns = (l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=20))
+    dense = l63_data.observe(traj_da, mask_fns, sigma=1., rng=0)
+    obs = l63_data.observation_fn(*mask_fns, sigma=1., rng=0, sparse=True)(traj_da)
+    assert isinstance(obs, l63_data.SparseObs)
+    np.testing.assert_array_equal(l63_data.densify(obs), dense.values)
+    np.testing.assert_array_equal(l63_data.densify(l63_data.to_sparse(dense)), dense.values)
+    torch.testing.assert_close(
+        l63_data.densify(l63_data.SparseObs(torch.from_numpy(obs.index), torch.from_numpy(obs.values), obs.shape)),
+        torch.from_numpy(dense.values), equal_nan=True,
+    )
+    np.testing.assert_array_equal(
+        l63_data.densify(l63_data.slice_sparse(obs, 30, 90)), dense.values[:, 30:90]
+    )
+
+    ref = l63_data.training_da(traj_da, ft.partial(l63_data.observe, mask_fns=mask_fns, sigma=1., rng=0))
+    dense_da, sparse_obs = l63_data.sparse_training_da(
+        traj_da, l63_data.observation_fn(*mask_fns, sigma=1., rng=0, sparse=True)
+    )
+    xr.testing.assert_allclose(dense_da, ref.sel(variable=['init', 'tgt']))
+    np.testing.assert_array_equal(l63_data.densify(sparse_obs), ref.sel(variable='input').values)
+
+
+def test_datamodule_sparse_obs(traj_da):
+    obs_fn = lambda da: l63_data.subsample(l63_data.only_first_obs(da), sample_step=20)
+    domains = {'train': {'time': slice(None)}, 'val': {'time': slice(2.005, 8.)}, 'test': {'time': slice(None)}}
+    patch_dims = {'component': 3, 'time': 200}
+    dm = l63_data.LorenzDataModule(
+        l63_data.training_da(traj_da, obs_fn), domains=domains,
+        xrds_kw=dict(patch_dims={'variable': 3, **patch_dims}, strides={'time': 30}), dl_kw=dict(batch_size=4),
+    )
+    dense_da, obs = l63_data.sparse_training_da(traj_da, obs_fn)
+    dm_sparse = l63_data.LorenzDataModule(
+        dense_da, domains=domains, obs=obs,
+        xrds_kw=dict(patch_dims={'variable': 2, **patch_dims}, strides={'time': 30}), dl_kw=dict(batch_size=4),
+    )
+    dm.setup()
+    dm_sparse.setup()
+    assert isinstance(dm_sparse.val_ds, l63_data.SparseObsDataset)
+    batches, batches_sparse = list(dm.val_dataloader()), list(dm_sparse.val_dataloader())
+    assert len(batches) == len(batches_sparse)
+    for batch, batch_sparse in zip(batches, batches_sparse):
+        assert isinstance(batch_sparse.input, l63_data.SparseObs)
+        for field, field_sparse in zip(batch, l63_data.densify_batch(batch_sparse)):
+            torch.testing.assert_close(field, field_sparse, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        l63_data.LorenzDataModule(dense_da, domains=domains, obs=obs, collate_norm=True,
+                                  xrds_kw=dict(patch_dims={'variable': 2, **patch_dims}), dl_kw={})
+
+
+@pytest.fixture
+def on_the_fly_kw(solver_kw):
+    bank = l63_data.attractor_bank(l63_data.dyn_lorenz63, 32, solver_kw, dict(t_span=[0.01, 5.01], t_eval=None))
+    obs_fn = l63_data.observation_fn(
+        l63_data.mask_components, ft.partial(l63_data.mask_subsample, sample_step=20), sigma=1.
+    )
+    return dict(fn=l63_data.dyn_lorenz63, solver_kw={**solver_kw, 't_span': [0.01, 1.41],
+                't_eval': np.arange(0.01, 1.41, 0.01)[:140]}, obs_fn=obs_fn, bank=bank, margin=20)
+
+
+def test_on_the_fly_dataset(on_the_fly_kw):
+    ds_fn = lambda **kwargs: l63_data.OnTheFlyDataset(**on_the_fly_kw, batch_size=4, norm_stats=(1., 2.), **kwargs)
+    first, second = list(ds_fn(n_batches=3, seed=0)), list(ds_fn(n_batches=3, seed=0))
+    assert len(first) == 3
+    for batch, batch_again in zip(first, second):
+        assert batch._fields == l63_data.TrainingItemWithInit._fields
+        assert batch.tgt.shape == (4, 3, 100)
+        torch.testing.assert_close(batch, batch_again, equal_nan=True)
+    assert not torch.equal(first[0].tgt, first[1].tgt)
+    observed = first[0].input.isfinite()
+    assert observed[:, 0].any() and not observed[:, 1:].any()
+    assert first[0].init[:, 0].isfinite().all()
+
+    stream = iter(ds_fn())
+    assert all(next(stream).tgt.shape == (4, 3, 100) for _ in range(5))
+
+
+def test_on_the_fly_windows_do_not_repeat(on_the_fly_kw):
+    ds = l63_data.OnTheFlyDataset(**{**on_the_fly_kw, 'bank': on_the_fly_kw['bank'][:8]}, batch_size=8,
+                                  n_batches=25, seed=0)
+    tgt = torch.cat([batch.tgt for batch in ds])
+    assert len(tgt) == 200
+    assert len(torch.unique(tgt, dim=0)) == 200
+
+
+def test_datamodule_on_the_fly(datamodule_fn, on_the_fly_kw):
+    dm = datamodule_fn(on_the_fly_kw=dict(on_the_fly_kw, n_batches=5, seed=0))
+    dm.setup()
+    assert isinstance(dm.train_ds, l63_data.OnTheFlyDataset)
+    assert dm.train_ds.norm_stats == dm.norm_stats()
+    batches = list(dm.train_dataloader())
+    assert len(batches) == 5
+    assert all(batch.tgt.shape == (4, 3, 100) for batch in batches)
+    assert len(list(dm.val_dataloader())) > 0
+
+    dm = datamodule_fn(on_the_fly_kw=dict(on_the_fly_kw, n_batches=5), dl_kw=dict(batch_size=4, num_workers=2))
+    dm.setup()
+    assert len(list(dm.train_dataloader())) == 5
+
+    with pytest.raises(ValueError):
+        datamodule_fn(on_the_fly_kw=on_the_fly_kw, with_index=True)
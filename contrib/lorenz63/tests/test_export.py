@@ -0,0 +1,58 @@
+"""Unit tests for the lorenz63 TorchScript export"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+pytest.importorskip("kornia")
+pytest.importorskip("xarray")
+pytest.importorskip("src.models")
+
+import contrib.lorenz63.export as l63_export  # pylint: disable=wrong-import-position
+import contrib.lorenz63.models as l63_models  # pylint: disable=wrong-import-position
+
+
+@pytest.mark.parametrize('prior_cls, grad_cls, n_priors', [
+    (l63_models.RearrangedBilinAEPriorCost, l63_models.RearrangedConvLstmGradModel, 1),
+    (l63_models.RearrangedBilinAEPriorCost, l63_models.RearrangedConvLstmGradModel, 2),
+    (l63_models.Conv1dBilinAEPriorCost, l63_models.Conv1dConvLstmGradModel, 1),
+])
+def test_exported_solver_matches_eager(tmp_path, batch, prior_cls, grad_cls, n_priors):
+    torch.manual_seed(0)
+    priors = [prior_cls(dim_in=20, dim_hidden=8) for _ in range(n_priors)]
+    solver = l63_models.SolverWithInit(
+        prior_cost=priors[0] if n_priors == 1 else l63_models.MultiPrior(*priors),
+        obs_cost=l63_models.src.models.BaseObsCost(w=2.),
+        grad_mod=grad_cls(dim_in=20, dim_hidden=8),
+        n_step=4,
+    ).eval()
+    path = str(tmp_path / 'solver.pt')
+    l63_export.export_solver(solver, path)
+    exported = l63_export.load_solver(path)
+    torch.testing.assert_close(exported(batch.input, batch.init), solver(batch))
+
+
+def test_export_rejects_custom_layouts():
+    solver = l63_models.SolverWithInit(
+        prior_cost=l63_models.RearrangedBilinAEPriorCost('b c t', 'b c t ()', dim_in=3, dim_hidden=8),
+        obs_cost=l63_models.src.models.BaseObsCost(),
+        grad_mod=l63_models.RearrangedConvLstmGradModel(dim_in=20, dim_hidden=8),
+        n_step=2,
+    )
+    with pytest.raises(NotImplementedError):
+        l63_export.export_solver(solver)
+
+
+def test_export_rejects_custom_obs_cost():
+    class ScaledObsCost(l63_models.src.models.BaseObsCost):
+        def forward(self, state, batch):
+            return 2 * super().forward(state, batch)
+
+    solver = l63_models.SolverWithInit(
+        prior_cost=l63_models.RearrangedBilinAEPriorCost(dim_in=20, dim_hidden=8),
+        obs_cost=ScaledObsCost(),
+        grad_mod=l63_models.RearrangedConvLstmGradModel(dim_in=20, dim_hidden=8),
+        n_step=2,
+    )
+    with pytest.raises(NotImplementedError):
+        l63_export.export_solver(solver)
@@ -0,0 +1,310 @@
+"""Unit tests for lorenz63 models"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+pytest.importorskip("kornia")
+pytest.importorskip("xarray")
+pytest.importorskip("src.models")
+
+import contrib.lorenz63.models as l63_models  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def priors():
+    torch.manual_seed(0)
+    return [l63_models.RearrangedBilinAEPriorCost(dim_in=20, dim_hidden=8) for _ in range(3)] + [
+        l63_models.RearrangedBilinAEPriorCost(dim_in=20, dim_hidden=4)
+    ]
+
+
+def test_multi_prior_fused_matches_loop(priors):
+    x = torch.randn(5, 3, 20, requires_grad=True)
+    loop, fused = l63_models.MultiPrior(*priors), l63_models.MultiPrior(*priors, fused=True)
+    assert len(fused.prior_groups()) == 2
+
+    ref_ae = torch.stack([prior.forward_ae(x) for prior in priors]).mean(0)
+    torch.testing.assert_close(loop.forward_ae(x), ref_ae)
+    torch.testing.assert_close(fused.forward_ae(x), ref_ae)
+
+    cost_loop, cost_fused = loop(x), fused(x)
+    torch.testing.assert_close(cost_loop, cost_fused)
+    torch.testing.assert_close(
+        torch.autograd.grad(cost_loop, x)[0], torch.autograd.grad(cost_fused, x)[0]
+    )
+
+
+def test_multi_prior_fused_trains_prior_parameters(priors):
+    x = torch.randn(5, 3, 20)
+    l63_models.MultiPrior(*priors, fused=True)(x).backward()
+    assert all(prior.conv_in.weight.grad is not None for prior in priors)
+
+
+def _solver(**kwargs):
+    torch.manual_seed(0)
+    return l63_models.SolverWithInit(
+        prior_cost=l63_models.RearrangedBilinAEPriorCost(dim_in=20, dim_hidden=8),
+        obs_cost=l63_models.src.models.BaseObsCost(),
+        grad_mod=l63_models.RearrangedConvLstmGradModel(dim_in=20, dim_hidden=8, dropout=0.),
+        **{'n_step': 3, **kwargs},
+    )
+
+
+def test_solver_rearranged_layout_matches_per_call_rearrange(batch):
+    ref_solver, solver = _solver(), _solver(rearrange_from='b c t', rearrange_to='b t c ()')
+    ref, out = ref_solver(batch), solver(batch)
+    assert out.shape == batch.tgt.shape
+    torch.testing.assert_close(out, ref)
+
+    ref_grads = torch.autograd.grad(ref.sum(), list(ref_solver.parameters()), allow_unused=True)
+    grads = torch.autograd.grad(out.sum(), list(solver.parameters()), allow_unused=True)
+    for g, ref_g in zip(grads, ref_grads):
+        torch.testing.assert_close(g, ref_g)
+
+    ref_solver.eval(), solver.eval()
+    torch.testing.assert_close(solver(batch), ref_solver(batch))
+
+
+def test_conv1d_models_match_rearranged_2d_models():
+    torch.manual_seed(0)
+    x = torch.randn(4, 3, 20)
+    for cls_2d, cls_1d, kw in [
+        (l63_models.RearrangedBilinAEPriorCost, l63_models.Conv1dBilinAEPriorCost, {}),
+        (l63_models.RearrangedConvLstmGradModel, l63_models.Conv1dConvLstmGradModel, dict(dropout=0.)),
+    ]:
+        mod_2d, mod_1d = cls_2d(dim_in=20, dim_hidden=8, **kw), cls_1d(dim_in=20, dim_hidden=8, **kw)
+        mod_1d.load_state_dict(l63_models.conv1d_state_dict(mod_2d.state_dict()))
+        assert not any(isinstance(m, torch.nn.Conv2d) for m in mod_1d.modules())
+        if hasattr(mod_2d, 'reset_state'):
+            mod_2d.reset_state(x), mod_1d.reset_state(x)
+            torch.testing.assert_close(mod_1d(x), mod_2d(x))
+            torch.testing.assert_close(mod_1d(x), mod_2d(x))
+        else:
+            torch.testing.assert_close(mod_1d.forward_ae(x), mod_2d.forward_ae(x))
+            torch.testing.assert_close(mod_1d(x), mod_2d(x))
+
+
+def test_solver_rearrangement_needs_distinct_layouts():
+    with pytest.raises(ValueError):
+        _solver(rearrange_from='b c t', rearrange_to='b t c')
+
+
+def _lit_model(**kwargs):
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    return l63_models.LitLorenz(
+        _solver(), rec_weight=np.ones((3, 20), dtype=np.float32), opt_fn=None, norm_stats=(0., 1.), **kwargs
+    )
+
+
+def test_lit_step_reuses_solver_prior_cost(monkeypatch, batch):
+    lit = _lit_model(reuse_prior_cost=True)
+    monkeypatch.setattr(l63_models.kfilts, 'sobel', None)  # grad loss disabled by default
+
+    loss, out = lit.step(batch, 'train')
+    assert len(lit.solver.prior_costs) == lit.solver.n_step
+    mse = lit.weighted_mse(out - batch.tgt, lit.rec_weight)
+    torch.testing.assert_close(loss, mse + lit.solver.prior_costs[-1])
+    loss.backward()
+    assert lit.solver.prior_cost.conv_in.weight.grad is not None
+
+
+def test_lit_step_evaluates_prior_on_output_by_default(batch):
+    lit = _lit_model()
+    loss, out = lit.step(batch, 'train')
+    mse = lit.weighted_mse(out - batch.tgt, lit.rec_weight)
+    torch.testing.assert_close(loss, mse + lit.solver.prior_cost(out))
+
+
+def test_lit_step_grad_loss_weight(batch):
+    loss, _ = _lit_model().step(batch, 'train')
+    weighted_loss, _ = _lit_model(grad_loss_weight=10.).step(batch, 'train')
+    assert weighted_loss > loss
+
+
+def test_patch_metrics_streaming_matches_concatenated():
+    torch.manual_seed(0)
+    outs, tgts = torch.randn(5, 4, 3, 60), torch.randn(5, 4, 3, 60)
+    metrics, other = l63_models.PatchMetrics(crop=20), l63_models.PatchMetrics(crop=20)
+    for i, (out, tgt) in enumerate(zip(outs, tgts)):
+        (metrics if i < 3 else other).update(out, tgt)
+    metrics.merge_state(other)  # as summed across processes
+    res = metrics.compute()
+
+    sq_err = (tgts - outs)**2
+    torch.testing.assert_close(res['mse'].float(), sq_err.mean())
+    torch.testing.assert_close(res['percent_err'].float(), sq_err.mean() / (tgts**2).mean())
+    torch.testing.assert_close(res['crop_mse'].float(), sq_err[..., 20:-20].mean())
+
+
+@pytest.mark.parametrize('store_test_data', [True, False])
+def test_lit_test_step_updates_patch_metrics(store_test_data, batch):
+    lit = _lit_model(store_test_data=store_test_data)
+    lit.eval()
+    lit.test_step(batch, 0)
+    lit.test_step(batch, 1)
+    assert (lit.test_data is not None) == store_test_data
+    out = lit(batch=batch).detach()
+    torch.testing.assert_close(lit.patch_metrics.compute()['mse'].float(), ((out - batch.tgt)**2).mean())
+
+
+def test_metrics_single_pass():
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import xarray as xr  # pylint: disable=import-outside-toplevel
+
+    rng = np.random.default_rng(0)
+    tgt, out = rng.normal(size=(2, 8, 3, 50))
+    res = l63_models.metrics(torch.from_numpy(out), tgt)
+    sq_err = (out - tgt)**2
+    np.testing.assert_allclose(res.mse, sq_err.mean())
+    np.testing.assert_allclose(res.rmse, np.sqrt(sq_err.mean()))
+    np.testing.assert_allclose(res.percent_err, sq_err.mean() / (tgt**2).mean())
+    np.testing.assert_allclose(res.component_mse, sq_err.mean((0, 2)))
+    np.testing.assert_allclose(res.lead_time_mse, sq_err.mean((0, 1)))
+    assert res.spectral_err.shape == (26,)
+    np.testing.assert_allclose(l63_models.metrics(tgt, tgt).spectral_err, 0)
+
+    rec_ds = xr.Dataset({
+        'out': (('time', 'component'), out[0].T), 'tgt': (('time', 'component'), tgt[0].T)
+    })
+    rec_ds['out'][3, 1] = np.nan
+    legacy_mse = ((rec_ds.tgt - rec_ds.out)**2).mean().values.item()
+    np.testing.assert_allclose(l63_models.mse(rec_ds), legacy_mse)
+    np.testing.assert_allclose(
+        l63_models.rec_metrics(rec_ds).component_mse, ((rec_ds.tgt - rec_ds.out)**2).mean('time')
+    )
+
+
+def test_solver_grad_checkpoint_matches_full_backprop(batch):
+    ref_solver, solver = _solver(), _solver(grad_checkpoint=True)
+    ref, out = ref_solver(batch), solver(batch)
+    torch.testing.assert_close(out, ref)
+    assert len(solver.prior_costs) == solver.n_step
+
+    ref_loss = ref.pow(2).mean() + ref_solver.prior_costs[-1]
+    loss = out.pow(2).mean() + solver.prior_costs[-1]
+    ref_grads = torch.autograd.grad(ref_loss, list(ref_solver.parameters()), allow_unused=True)
+    grads = torch.autograd.grad(loss, list(solver.parameters()), allow_unused=True)
+    assert len(solver.prior_costs) == solver.n_step
+    for g, ref_g in zip(grads, ref_grads):
+        torch.testing.assert_close(g, ref_g)
+
+
+def test_solver_truncated_backprop(batch):
+    ref_solver, solver = _solver(), _solver(n_step_grad=1)
+    torch.testing.assert_close(solver(batch), ref_solver(batch))
+    assert not solver.prior_costs[0].requires_grad and solver.prior_costs[-1].requires_grad
+
+    solver.eval(), ref_solver.eval()
+    torch.testing.assert_close(solver(batch), ref_solver(batch))
+
+
+def test_solver_warm_start(batch):
+    import contrib.lorenz63.data as l63_data  # pylint: disable=import-outside-toplevel
+    import contrib.lorenz63.warm_start as l63_warm_start  # pylint: disable=import-outside-toplevel
+
+    batch = l63_data.IndexedTrainingItem(*batch, idx=torch.arange(4))
+    store = l63_warm_start.WarmStartStore()
+    solver = _solver(warm_start=store, rearrange_from='b c t', rearrange_to='b t c ()')
+    first = solver(batch)
+    assert len(store) == 4
+    torch.testing.assert_close(solver.init_state(batch._replace(init=solver._rearrange(batch.init))),
+                               solver._rearrange(first.detach()))
+    second = solver(batch)
+    assert not torch.allclose(first, second)
+    torch.testing.assert_close(second, _solver()(batch._replace(init=first.detach())))
+
+    solver.eval()
+    torch.testing.assert_close(solver(batch), _solver().eval()(batch))
+
+
+def test_solver_early_stopping(batch):
+    ref_solver = _solver(n_step=6).eval()
+    ref = ref_solver(batch)
+
+    # a tolerance that is never reached runs all the iterations of the full batch loop
+    solver = _solver(n_step=6, early_stop_tol=float('-inf')).eval()
+    torch.testing.assert_close(solver(batch), ref)
+    assert solver.n_iter.tolist() == [6] * 4
+
+    solver = _solver(n_step=6, early_stop_tol=1e6).eval()
+    out = solver(batch)
+    assert solver.n_iter.tolist() == [1] * 4
+    torch.testing.assert_close(out, _solver(n_step=1, lr_grad=0.2 / 6).eval()(batch))
+
+
+def test_solver_early_stopping_rejects_unknown_costs():
+    class ScaledObsCost(l63_models.src.models.BaseObsCost):
+        def forward(self, state, batch):
+            return 2 * super().forward(state, batch)
+
+    class L1PriorCost(l63_models.RearrangedBilinAEPriorCost):
+        def forward(self, state):
+            return (state - self.forward_ae(state)).abs().mean()
+
+    solver = _solver()
+    solver_kw = dict(prior_cost=solver.prior_cost, obs_cost=solver.obs_cost, grad_mod=solver.grad_mod, n_step=3)
+    with pytest.raises(NotImplementedError):
+        l63_models.SolverWithInit(**{**solver_kw, 'obs_cost': ScaledObsCost()}, early_stop_tol=1e-2)
+    multi_prior = l63_models.MultiPrior(solver.prior_cost, L1PriorCost(dim_in=20, dim_hidden=8))
+    with pytest.raises(NotImplementedError):
+        l63_models.SolverWithInit(**{**solver_kw, 'prior_cost': multi_prior}, early_stop_tol=1e-2)
+    l63_models.SolverWithInit(**{**solver_kw, 'obs_cost': ScaledObsCost()})
+    l63_models.SolverWithInit(**{
+        **solver_kw, 'prior_cost': l63_models.DynRegularizedPrior(solver.prior_cost, l63_models.LorenzDynCost()),
+    }, early_stop_tol=1e-2)
+
+
+def test_solver_densifies_sparse_input(batch):
+    import contrib.lorenz63.data as l63_data  # pylint: disable=import-outside-toplevel
+
+    solver = _solver()
+    obs = l63_data.to_sparse(batch.input.numpy())
+    sparse_batch = batch._replace(input=l63_data.SparseObs(
+        torch.from_numpy(obs.index), torch.from_numpy(obs.values), obs.shape
+    ))
+    torch.testing.assert_close(solver(sparse_batch), solver(batch))
+
+
+def test_rk4_lorenz63_matches_numpy_rk4():
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import contrib.lorenz63.data as l63_data  # pylint: disable=import-outside-toplevel
+
+    y = np.random.default_rng(0).normal(size=(3, 5)) * 5 + [[0.], [0.], [25.]]
+    ref = l63_data._rk4_step(l63_data.dyn_lorenz63, 0., y, 0.01)  # pylint: disable=protected-access
+    out = l63_models.rk4_lorenz63(torch.from_numpy(y)[None], 0.01)[0]
+    np.testing.assert_allclose(out.numpy(), ref, rtol=1e-12)
+
+
+def test_dyn_cost_vanishes_on_trajectories():
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import contrib.lorenz63.data as l63_data  # pylint: disable=import-outside-toplevel
+
+    traj = l63_data.ensemble_trajectory_da(
+        l63_data.dyn_lorenz63, np.array([[8., 0., 30.], [1., 1., 20.]]),
+        dict(t_span=[0., 0.5], first_step=0.01, method='RK4'),
+    )
+    norm_stats = (2., 8.)
+    x = (torch.from_numpy(traj.values) - norm_stats[0]) / norm_stats[1]
+    cost = l63_models.LorenzDynCost(dt=0.01, norm_stats=norm_stats)
+    assert cost(x) < 1e-20
+    noisy = x + 0.01 * torch.randn_like(x)
+    image = noisy.transpose(1, 2)[..., None]
+    torch.testing.assert_close(cost(image), cost(noisy))
+    torch.testing.assert_close(cost.cost_per_sample(noisy).mean(), cost(noisy))
+
+
+def test_solver_with_dyn_regularized_prior(batch):
+    solver = _solver()
+    solver.prior_cost = l63_models.DynRegularizedPrior(
+        solver.prior_cost, l63_models.LorenzDynCost(norm_stats=(0., 10.)), weight=0.5
+    )
+    out = solver(batch)
+    assert out.shape == batch.tgt.shape
+    out.sum().backward()
+    assert solver.prior_cost.prior.conv_in.weight.grad is not None
+    state = batch.init.clone()
+    torch.testing.assert_close(
+        l63_models.prior_cost_per_sample(solver.prior_cost, state).mean(), solver.prior_cost(state)
+    )
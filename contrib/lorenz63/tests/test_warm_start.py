@@ -0,0 +1,43 @@
+"""Unit tests for the lorenz63 solver warm-start store"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("numpy")
+
+import contrib.lorenz63.warm_start as l63_warm_start  # pylint: disable=wrong-import-position
+
+
+def test_get_falls_back_to_default():
+    store = l63_warm_start.WarmStartStore()
+    store.put(torch.tensor([1, 3]), torch.ones(2, 3, 5))
+    states, hits = store.get(torch.tensor([0, 1, 2, 3]), torch.zeros(4, 3, 5))
+    assert hits.tolist() == [False, True, False, True]
+    assert states[hits].eq(1).all() and states[~hits].eq(0).all()
+
+
+def test_put_stores_detached_copies():
+    store = l63_warm_start.WarmStartStore()
+    states = torch.ones(2, 3, requires_grad=True)
+    store.put([0, 1], states * 2)
+    out, _ = store.get([0, 1], torch.zeros(2, 3))
+    assert not out.requires_grad
+    torch.testing.assert_close(out, torch.full((2, 3), 2.))
+
+
+def test_eviction_and_spill(tmp_path):
+    store = l63_warm_start.WarmStartStore(max_items=2)
+    store.put([0, 1, 2], torch.arange(3.)[:, None].expand(3, 4))
+    assert len(store) == 2 and 0 not in store and 2 in store
+
+    store = l63_warm_start.WarmStartStore(max_items=2, spill_dir=str(tmp_path))
+    store.put([0, 1], torch.arange(2.)[:, None].expand(2, 4))
+    store.get([0], torch.zeros(1, 4))  # 1 becomes least recently used
+    store.put([2], torch.full((1, 4), 2.))
+    assert len(store) == 2 and 1 in store
+    states, hits = store.get([1, 2, 5], torch.full((3, 4), -1.))
+    assert hits.tolist() == [True, True, False]
+    torch.testing.assert_close(states[:, 0], torch.tensor([1., 2., -1.]))
+
+    store.clear()
+    assert len(store) == 0 and 1 not in store
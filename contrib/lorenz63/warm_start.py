@@ -0,0 +1,85 @@
+"""
+Per-sample warm-start store for the solver initial states.
+
+The solver output of a training item is stored under its dataset index and used as the
+initial state the next time the item is drawn (typically at the next epoch), instead of
+starting again from the interpolated observations. The in-memory store is bounded and
+least recently used states are evicted, or spilled to disk when `spill_dir` is given.
+"""
+
+import collections
+import os
+import numpy as np
+import torch
+
+
+class WarmStartStore:
+    """
+    Solver states keyed by dataset index.
+
+    Args:
+        max_items (int, optional): Maximum number of states kept in memory, unbounded if None.
+        spill_dir (str, optional): Directory where evicted states are written as `.npy` files
+            and read back from. Evicted states are dropped when None.
+    """
+    def __init__(self, max_items=None, spill_dir=None):
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        self._states = collections.OrderedDict()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, idx):
+        return os.path.join(self.spill_dir, f'{idx}.npy')
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, idx):
+        return idx in self._states or (
+            self.spill_dir is not None and os.path.isfile(self._spill_path(idx))
+        )
+
+    def _get_one(self, idx):
+        if idx in self._states:
+            self._states.move_to_end(idx)
+            return self._states[idx]
+        if self.spill_dir is not None and os.path.isfile(self._spill_path(idx)):
+            return torch.from_numpy(np.load(self._spill_path(idx)))
+        return None
+
+    def get(self, indices, default):
+        """
+        Stored states of `indices`, rows without a stored state are taken from `default`.
+
+        Returns:
+            tuple: The (batch, ...) states on the device and dtype of `default`, and a boolean
+            tensor flagging the rows read from the store.
+        """
+        indices = torch.as_tensor(indices).tolist()
+        states = [self._get_one(idx) for idx in indices]
+        hits = torch.tensor([s is not None for s in states])
+        if not hits.any():
+            return default, hits
+        out = default.clone()
+        out[hits.to(out.device)] = torch.stack([s for s in states if s is not None]).to(out)
+        return out, hits
+
+    def put(self, indices, states):
+        """ Store (a detached CPU copy of) `states` under `indices` and evict above `max_items`. """
+        states = states.detach().cpu()
+        for idx, state in zip(torch.as_tensor(indices).tolist(), states):
+            self._states[idx] = state.clone()
+            self._states.move_to_end(idx)
+        while self.max_items is not None and len(self._states) > self.max_items:
+            idx, state = self._states.popitem(last=False)
+            if self.spill_dir is not None:
+                np.save(self._spill_path(idx), state.numpy())
+
+    def clear(self):
+        """ Remove all states, including the spilled ones. """
+        self._states.clear()
+        if self.spill_dir is not None:
+            for name in os.listdir(self.spill_dir):
+                if name.endswith('.npy'):
+                    os.remove(os.path.join(self.spill_dir, name))